@@ -0,0 +1,199 @@
+import time
+import math
+import asyncio
+import ipaddress
+from collections import OrderedDict
+
+# -----------------------------
+# Admission control
+# -----------------------------
+# Two layers keep one noisy client from starving everyone else:
+#   * a token bucket per client (API key, else IP) and route rule, answering
+#     429 once a client is over its rate;
+#   * a concurrency limit per upstream with a short wait queue, answering 503
+#     instead of letting requests pile up on a saturated service.
+# Both rejections carry Retry-After.
+#
+# Behind a load balancer every connection comes from the LB, so the client IP
+# is taken from X-Forwarded-For, but only when the connection comes from one
+# of `trusted_proxies`; anyone else could put any address in that header.
+
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    "enabled": True,
+    "client_header": "X-API-Key",
+    "trust_forwarded_for": False,
+    "trusted_proxies": [],
+    "max_clients": 100000,
+    "exempt_paths": ["/health", "/ready"],
+    "default": {"rate": 50.0, "burst": 100},
+    "routes": []
+}
+
+DEFAULT_CONCURRENCY_SETTINGS = {
+    "max_concurrent": 100,
+    "max_queue": 50,
+    "queue_timeout": 0.5
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token; returns 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, settings):
+        self.settings = {**DEFAULT_RATE_LIMIT_SETTINGS, **settings}
+        self.enabled = self.settings["enabled"]
+        self.max_clients = self.settings["max_clients"]
+        self.default_rule = {**DEFAULT_RATE_LIMIT_SETTINGS["default"], **self.settings["default"]}
+        # each rule: {"methods": [...] (optional), "path_prefix": "...", "rate": ..., "burst": ...}
+        self.rules = self.settings["routes"]
+        self.trusted_proxies = [ipaddress.ip_network(cidr) for cidr in self.settings["trusted_proxies"]]
+        self.buckets = OrderedDict()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def trusted(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def client_ip(self, request):
+        peer = request.client.host if request.client else "unknown"
+        if not self.settings["trust_forwarded_for"] or not self.trusted(peer):
+            return peer
+        # Each proxy appends the address it saw; the rightmost one that is not
+        # a trusted proxy is the client (anything left of it is client-supplied)
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not self.trusted(hop):
+                return hop
+        return hops[0] if hops else peer
+
+    def client_id(self, request):
+        key = request.headers.get(self.settings["client_header"])
+        if key:
+            return f"key:{key}"
+        return f"ip:{self.client_ip(request)}"
+
+    def rule_for(self, method, path):
+        """Return (rule index, rule) for the first matching route rule; index -1 is the default."""
+        for index, rule in enumerate(self.rules):
+            if "methods" in rule and method not in rule["methods"]:
+                continue
+            if path.startswith(rule.get("path_prefix", "/")):
+                return index, rule
+        return -1, self.default_rule
+
+    def check(self, request):
+        """Returns 0 if the request may proceed, else the Retry-After in seconds."""
+        path = request.url.path
+        if not self.enabled or path in self.settings["exempt_paths"]:
+            return 0
+
+        index, rule = self.rule_for(request.method, path)
+        key = (self.client_id(request), index)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rule["rate"], rule["burst"])
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+
+        wait = bucket.take()
+        if wait:
+            self.limited += 1
+            return max(1, math.ceil(wait))
+        self.allowed += 1
+        return 0
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "tracked_buckets": len(self.buckets),
+            "allowed": self.allowed,
+            "limited": self.limited
+        }
+
+
+class UpstreamOverloaded(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is at its concurrency limit")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """At most `max_concurrent` calls at once; up to `max_queue` more wait briefly for a slot."""
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.max_concurrent = settings["max_concurrent"]
+        self.max_queue = settings["max_queue"]
+        self.queue_timeout = settings["queue_timeout"]
+        self.active = 0
+        self.waiters = OrderedDict()
+
+        self.queued = 0
+        self.shed = 0
+
+    async def acquire(self):
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.shed += 1
+            raise UpstreamOverloaded(self.name, 1)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[waiter] = None
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            self.waiters.pop(waiter, None)
+            if waiter.done() and not waiter.cancelled():
+                # a slot was handed to us just as we gave up; pass it on
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise UpstreamOverloaded(self.name, 1) from None
+            raise
+        # release() handed its slot straight to us, active is unchanged
+
+    def release(self):
+        while self.waiters:
+            waiter, _ = self.waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "queued_now": len(self.waiters),
+            "queued_total": self.queued,
+            "shed": self.shed
+        }
@@ -0,0 +1,137 @@
+import time
+import hashlib
+from collections import OrderedDict
+
+# -----------------------------
+# Gateway response cache
+# -----------------------------
+# Read-through TTL + LRU cache for upstream GET responses, bounded both by
+# entry count and by total body bytes. Entries carry tags (e.g. "user:<id>")
+# so a UserUpdated event can drop every response that embeds that user.
+
+DEFAULT_CACHE_SETTINGS = {
+    "enabled": True,
+    "ttl_seconds": 30.0,
+    "max_entries": 10000,
+    "max_bytes": 16 * 1024 * 1024,
+    "invalidate_from_events": True,
+    "event_reinvalidate_delay": 1.0
+}
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison (RFC 7232 2.3.2): ignore any W/ prefix
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+class CacheEntry:
+    __slots__ = ("body", "headers", "etag", "expires_at", "tags")
+
+    def __init__(self, body, headers, etag, expires_at, tags):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.expires_at = expires_at
+        self.tags = tags
+
+
+class ResponseCache:
+    def __init__(self, settings):
+        self.settings = {**DEFAULT_CACHE_SETTINGS, **settings}
+        self.enabled = self.settings["enabled"]
+        self.ttl = self.settings["ttl_seconds"]
+        self.max_entries = self.settings["max_entries"]
+        self.max_bytes = self.settings["max_bytes"]
+
+        self.entries = OrderedDict()
+        self.tag_index = {}
+        self.bytes_used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key, body, headers, tags=(), etag=None):
+        """
+        Store a 200 response body; returns its entry (or None when not cacheable).
+        Keeps the upstream's `etag` when it sent one, so If-Match on a later write
+        can use the ETag a cached read returned.
+        """
+        if not self.enabled or len(body) > self.max_bytes:
+            return None
+        if key in self.entries:
+            self._remove(key)
+
+        entry = CacheEntry(body, headers, etag or make_etag(body), time.monotonic() + self.ttl, tuple(tags))
+        self.entries[key] = entry
+        self.bytes_used += len(body)
+        for tag in entry.tags:
+            self.tag_index.setdefault(tag, set()).add(key)
+
+        while len(self.entries) > self.max_entries or self.bytes_used > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, key):
+        if key in self.entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def invalidate_tag(self, tag):
+        for key in list(self.tag_index.get(tag, ())):
+            self.invalidate(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes_used -= len(entry.body)
+        for tag in entry.tags:
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "bytes_used": self.bytes_used,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
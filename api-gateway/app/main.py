@@ -1,21 +1,32 @@
 import os
 import json
-import random
+import asyncio
+import math
+import time
 import httpx
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Body
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional
-
-app = FastAPI(
-    title="E-Commerce API Gateway",
-    version="1.0",
-    description="Gateway for User Services (V1 & V2) and Order Service with Strangler Pattern (70% V1, 30% V2)"
-)
+from .upstream import UpstreamRegistry, proxy_headers
+from .routing import StranglerRouter, UPSTREAM_FOR_VERSION, OTHER_VERSION, SCHEMA_FIELD
+from .cache import ResponseCache, etag_matches
+from .events import UserEventListener
+from .singleflight import SingleFlight
+from .resilience import CircuitOpenError
+from .admission import RateLimiter, UpstreamOverloaded
+from .readiness import add_check, serve_readiness
+from .metrics import instrument, registry
+from .tracing import trace_requests
+from .logs import setup_logging, log_requests
 
 # -----------------------------
 # Load configuration
 # -----------------------------
+setup_logging("api-gateway")
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_PATH = os.path.join(ROOT_DIR, "gateway-config.json")
 
@@ -23,10 +34,96 @@ with open(CONFIG_PATH, "r") as f:
     config = json.load(f)
 
 
-USER_V1_PERCENT = config["user_v1_percentage"]
 USER_V1_URL = config["user_v1_url"]
 USER_V2_URL = config["user_v2_url"]
 ORDER_URL = config["order_url"]
+MAX_BATCH_SIZE = config.get("max_batch_size", 500)
+# upper bound on user lookups one composed batch request keeps in flight
+COMPOSE_CONCURRENCY = config.get("composition", {}).get("max_concurrency", 20)
+
+upstreams = UpstreamRegistry.from_config(config, {
+    "user-v1": USER_V1_URL,
+    "user-v2": USER_V2_URL,
+    "order": ORDER_URL
+})
+
+# user_v1_percentage is re-read from the config file while running
+router = StranglerRouter(CONFIG_PATH, config)
+
+cache = ResponseCache(config.get("response_cache", {}))
+
+# per-client token buckets, checked before any handler runs
+rate_limiter = RateLimiter(config.get("rate_limits", {}))
+
+# collapses identical concurrent GETs that miss the cache into one upstream call
+singleflight = SingleFlight(config.get("single_flight", {}))
+
+# GET /traces exposes request paths and ids of every caller; the gateway is
+# public, so only serve it when asked (the services behind it always do)
+TRACES_ENDPOINT = os.getenv("TRACES_ENDPOINT", "false").lower() == "true"
+
+
+def on_user_event(event):
+    """Drop cached user and order responses that embed the updated user."""
+    user_id = event.get("userId")
+    if not user_id:
+        return
+    cache.invalidate_tag(f"user:{user_id}")
+    # order-service applies the same event asynchronously, so an order read in
+    # between could re-cache the old copy; drop the tag once more shortly after
+    delay = cache.settings["event_reinvalidate_delay"]
+    if delay:
+        asyncio.get_running_loop().call_later(delay, cache.invalidate_tag, f"user:{user_id}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upstreams.start()
+    listener = None
+    if cache.enabled and cache.settings["invalidate_from_events"]:
+        listener = UserEventListener(asyncio.get_running_loop(), on_user_event)
+        listener.start()
+        # Without it cached users go stale until their TTL, but requests still work
+        add_check("user-events", lambda: listener.channel is not None, required=False)
+    yield
+    if listener is not None:
+        listener.stop()
+    await upstreams.close()
+
+
+app = FastAPI(
+    title="E-Commerce API Gateway",
+    version="1.0",
+    description="Gateway for User Services (V1 & V2) and Order Service with Strangler Pattern (70% V1, 30% V2)",
+    lifespan=lifespan
+)
+
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    retry_after = rate_limiter.check(request)
+    if retry_after:
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Too many requests, slow down"},
+            headers={"Retry-After": str(retry_after)}
+        )
+    return await call_next(request)
+
+# registered after rate_limit so they wrap it, and 429s are timed and traced too
+instrument(app)
+trace_requests(app, "api-gateway", serve_traces=TRACES_ENDPOINT)
+log_requests(app)
+serve_readiness(app)
+
+registry.callback("gateway_upstream_in_flight", "Requests in flight per upstream", "gauge",
+                  lambda: {(name,): u.in_flight for name, u in upstreams.upstreams.items()}, ["upstream"])
+registry.callback("gateway_circuit_open", "1 while an upstream's circuit breaker is not closed", "gauge",
+                  lambda: {(name,): int(state != "closed") for name, state in upstreams.circuits().items()},
+                  ["upstream"])
+registry.callback("gateway_cache_hits_total", "Response cache hits", "counter", lambda: cache.hits)
+registry.callback("gateway_cache_misses_total", "Response cache misses", "counter", lambda: cache.misses)
+registry.callback("gateway_rate_limited_total", "Requests rejected by the rate limiter", "counter",
+                  lambda: rate_limiter.limited)
 
 # -----------------------------
 # Schemas
@@ -75,6 +172,16 @@ class OrderCreate(BaseModel):
 
 class UpdateStatus(BaseModel):
     status: str
+    leaseToken: Optional[str] = None
+
+class ClaimOrders(BaseModel):
+    worker: str
+    status: str = "PENDING"
+    limit: int = 10
+    leaseSeconds: Optional[float] = None
+
+class ReleaseOrders(BaseModel):
+    leaseToken: str
 
 class UpdateOrderEmail(BaseModel):
     email: str
@@ -82,31 +189,276 @@ class UpdateOrderEmail(BaseModel):
 class UpdateOrderAddress(BaseModel):
     deliveryAddress: str
 
-# Helper to forward request
-async def forward_request(request: Request, target_url: str):
-    async with httpx.AsyncClient() as client:
-        method = request.method
-        body = await request.body()
-        headers = dict(request.headers)
+def check_batch_size(items: list):
+    """Reject oversized batches here instead of shipping them to a service that will refuse them."""
+    if len(items) > MAX_BATCH_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Batch too large, max {MAX_BATCH_SIZE} items"}
+        )
+    return None
 
-        try:
-            response = await client.request(
-                method,
-                target_url,
-                content=body,
-                headers=headers
-            )
-        except Exception as e:
-            return JSONResponse(
-                status_code=500,
-                content={"error": f"Gateway could not reach microservice: {str(e)}"}
-            )
 
+# Helper to forward request
+def gateway_error(e: Exception):
+    if isinstance(e, CircuitOpenError):
+        return JSONResponse(
+            status_code=503,
+            content={"error": f"{e.name} is unavailable, try again later"},
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    if isinstance(e, UpstreamOverloaded):
         return JSONResponse(
-            content=response.json(),
-            status_code=response.status_code,
-            headers=response.headers
+            status_code=503,
+            content={"error": f"{e.name} is overloaded, try again later"},
+            headers={"Retry-After": str(e.retry_after)}
         )
+    if isinstance(e, httpx.TimeoutException):
+        return JSONResponse(
+            status_code=504,
+            content={"error": f"Microservice timed out: {str(e) or type(e).__name__}"}
+        )
+    return JSONResponse(
+        status_code=500,
+        content={"error": f"Gateway could not reach microservice: {str(e)}"}
+    )
+
+
+def request_content(request: Request):
+    """Stream the client body upstream, or send none when the client sent none."""
+    if "content-length" in request.headers or "transfer-encoding" in request.headers:
+        return request.stream()
+    return None
+
+
+async def forward_request(request: Request, upstream: str, path: str):
+    """
+    Proxy the request to an upstream service, piping both bodies through as raw
+    byte chunks instead of decoding and re-encoding the JSON.
+    """
+    pool = upstreams[upstream]
+    try:
+        response = await pool.send_stream(
+            request.method,
+            path,
+            params=request.query_params,
+            content=request_content(request),
+            headers=proxy_headers(request.headers)
+        )
+    except Exception as e:
+        return gateway_error(e)
+
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=proxy_headers(response.headers),
+        background=BackgroundTask(pool.close_stream, response)
+    )
+
+
+def buffered_response(response):
+    """Relay an already-read upstream response (httpx has decoded any content-encoding)."""
+    headers = proxy_headers(response.headers)
+    headers.pop("content-encoding", None)
+    headers.pop("content-length", None)
+    return Response(content=response.content, status_code=response.status_code, headers=headers)
+
+
+def cached_response(request: Request, entry, status: str):
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        cache.not_modified += 1
+        return Response(status_code=304, headers={"ETag": entry.etag, "X-Cache": status})
+    return Response(
+        content=entry.body,
+        status_code=200,
+        headers={**entry.headers, "ETag": entry.etag, "X-Cache": status}
+    )
+
+
+async def load_cached(key: str, fetch, tags):
+    """
+    Look `key` up in the response cache, or call fetch() and cache a 200 reply.
+    Concurrent misses for the same key share a single fetch() call.
+    `tags` is a list, or a function of the upstream response returning one.
+    Returns (entry, response): response is None on a cache hit, entry is None
+    when the reply was not cached. Upstream errors propagate.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        return entry, None
+
+    async def load():
+        response = await fetch()
+        if response.status_code != 200:
+            return None, response
+        headers = {"content-type": response.headers.get("content-type", "application/json")}
+        entry_tags = tags(response) if callable(tags) else tags
+        return cache.set(key, response.content, headers, entry_tags, response.headers.get("etag")), response
+
+    return await singleflight.do(key, load)
+
+
+async def cached_get(request: Request, fetch, tags):
+    """Serve a GET through load_cached(), keyed by the gateway path."""
+    try:
+        entry, response = await load_cached(f"GET {request.url.path}", fetch, tags)
+    except Exception as e:
+        return gateway_error(e)
+    if entry is None:
+        return buffered_response(response)
+    return cached_response(request, entry, "MISS" if response is not None else "HIT")
+
+
+def response_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {"error": response.text}
+
+
+async def load_json(key: str, fetch, tags):
+    """load_cached() for composed endpoints: returns (status_code, parsed body)."""
+    entry, response = await load_cached(key, fetch, tags)
+    if entry is not None:
+        return 200, json.loads(entry.body)
+    return response.status_code, response_json(response)
+
+
+def order_tags(orderId: str):
+    return lambda response: [f"order:{orderId}", f"user:{response.json()['userId']}"]
+
+
+async def user_request(version: str, method: str, path: str, probe=False, **kwargs):
+    """
+    Call the user service for `version`, feeding its latency and outcome to the
+    router. A `probe` asks a version that may not own the user, so only a
+    failure to get any reply counts against its health.
+    """
+    started = time.monotonic()
+    try:
+        response = await upstreams[UPSTREAM_FOR_VERSION[version]].request(method, path, **kwargs)
+    except Exception:
+        router.record(version, time.monotonic() - started, ok=False)
+        raise
+    router.record(version, time.monotonic() - started, ok=probe or response.status_code < 500)
+    return response
+
+
+async def fetch_user(userId: str):
+    """
+    Fetch a user from the version that owns it. Users created through the
+    gateway are fetched in one hop; unknown ids are looked up in both
+    versions and the owner is remembered for next time.
+    """
+    version = router.owner(userId)
+    if version:
+        return await user_request(version, "GET", f"/users/{userId}")
+    return await probe_user(userId)
+
+
+def owns(version, response):
+    """Whether `response` is `version` returning a user of its own schema."""
+    if response.status_code != 200:
+        return False
+    try:
+        return SCHEMA_FIELD[version] in response.json()
+    except (ValueError, TypeError):
+        return False
+
+
+async def probe_user(userId: str):
+    """
+    Look a user up in the healthier version first. If it has not answered
+    within the router's hedge delay (or does not own the user), ask the other
+    version too, and return the first reply from the version that owns it.
+    Replies that are errors, or a user in the other version's schema, mean
+    "not owned here"; they are returned only when neither version owns it.
+    """
+    first, second = router.probe_order()
+    tasks = {}
+
+    def ask(version):
+        task = asyncio.ensure_future(user_request(version, "GET", f"/users/{userId}", probe=True))
+        tasks[task] = version
+        return task
+
+    pending = {ask(first)}
+    hedge_delay = router.hedge_delay(first)
+    not_found = None
+    failed = None
+    error = None
+    try:
+        while pending:
+            timeout = hedge_delay if len(tasks) == 1 else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                router.hedged += 1
+                pending.add(ask(second))
+                continue
+
+            for task in done:
+                try:
+                    response = task.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if owns(tasks[task], response):
+                    router.remember(userId, tasks[task])
+                    return response
+                if response.status_code == 404:
+                    not_found = response
+                else:
+                    failed = response
+
+            if len(tasks) == 1:
+                pending.add(ask(second))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Neither version has it, unless one of them could not be asked or failed
+    if failed is not None:
+        return failed
+    if error is not None:
+        raise error
+    return not_found
+
+
+def remember_created(response, version):
+    """Remember `version` as the owner of the user a create returned, if it succeeded."""
+    if not 200 <= response.status_code < 300:
+        return
+    try:
+        user_id = response.json().get("userId")
+    except (ValueError, AttributeError):
+        return
+    if user_id:
+        router.remember(user_id, version)
+
+
+async def create_user(request: Request, version: str):
+    """Create a user on an explicitly chosen version; buffered so the new id can be remembered."""
+    try:
+        response = await user_request(version, "POST", "/users", content=await request.body(),
+                                      headers=proxy_headers(request.headers))
+    except Exception as e:
+        return gateway_error(e)
+    remember_created(response, version)
+    return buffered_response(response)
+
+
+# Composed endpoints share cache entries with GET /orders/{id} and GET /users/{id}
+
+def load_order(orderId: str):
+    return load_json(
+        f"GET /orders/{orderId}",
+        lambda: upstreams["order"].request("GET", f"/orders/{orderId}"),
+        order_tags(orderId)
+    )
+
+
+def load_user(userId: str):
+    return load_json(f"GET /users/{userId}", lambda: fetch_user(userId), [f"user:{userId}"])
 
 
 # =============================================================================
@@ -114,64 +466,84 @@ async def forward_request(request: Request, target_url: str):
 # =============================================================================
 
 @app.post("/users/v1", tags=["User Service V1"], summary="Create User (V1 Schema)")
-async def create_user_v1(user: UserCreateV1):
+async def create_user_v1(user: UserCreateV1, request: Request):
     """Create a new user using V1 schema (simple: email + deliveryAddress)"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{USER_V1_URL}/users", json=user.dict())
-        return response.json()
+    return await create_user(request, "V1")
+
+@app.post("/users/v1/batch", tags=["User Service V1"], summary="Create Users in Bulk (V1)")
+async def create_users_v1(users: List[UserCreateV1], request: Request):
+    """Create many V1 users with one insert; per-item failures are listed under `errors`"""
+    return check_batch_size(users) or await forward_request(request, "user-v1", "/users/batch")
+
+@app.get("/users/v1", tags=["User Service V1"], summary="Get Many Users by ID (V1)")
+async def get_users_v1(ids: str, request: Request):
+    """Fetch several V1 users in one round trip: ?ids=id1,id2,..."""
+    return await forward_request(request, "user-v1", "/users")
 
 @app.put("/users/v1/{userId}/email", tags=["User Service V1"], summary="Update User Email (V1)")
-async def update_user_email_v1(userId: str, data: UpdateEmailV1):
+async def update_user_email_v1(userId: str, data: UpdateEmailV1, request: Request):
     """Update user email in V1 service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{USER_V1_URL}/users/{userId}/email", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "user-v1", f"/users/{userId}/email")
+    cache.invalidate_tag(f"user:{userId}")
+    return response
 
 @app.put("/users/v1/{userId}/address", tags=["User Service V1"], summary="Update User Address (V1)")
-async def update_user_address_v1(userId: str, data: UpdateAddressV1):
+async def update_user_address_v1(userId: str, data: UpdateAddressV1, request: Request):
     """Update user delivery address in V1 service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{USER_V1_URL}/users/{userId}/address", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "user-v1", f"/users/{userId}/address")
+    cache.invalidate_tag(f"user:{userId}")
+    return response
 
 @app.get("/users/v1/{userId}", tags=["User Service V1"], summary="Get User by ID (V1)")
-async def get_user_v1(userId: str):
+async def get_user_v1(userId: str, request: Request):
     """Get user details by userId from V1 service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_V1_URL}/users/{userId}")
-        return response.json()
+    return await cached_get(
+        request,
+        lambda: upstreams["user-v1"].request("GET", f"/users/{userId}"),
+        [f"user:{userId}"]
+    )
 
 # =============================================================================
 # USER SERVICE V2 ENDPOINTS (30% traffic via Strangler Pattern)
 # =============================================================================
 
 @app.post("/users/v2", tags=["User Service V2"], summary="Create User (V2 Schema)")
-async def create_user_v2(user: UserCreateV2):
+async def create_user_v2(user: UserCreateV2, request: Request):
     """Create a new user using V2 schema (enhanced: firstName, lastName, phone, structured address)"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{USER_V2_URL}/users", json=user.dict())
-        return response.json()
+    return await create_user(request, "V2")
+
+@app.post("/users/v2/batch", tags=["User Service V2"], summary="Create Users in Bulk (V2)")
+async def create_users_v2(users: List[UserCreateV2], request: Request):
+    """Create many V2 users with one insert; per-item failures are listed under `errors`"""
+    return check_batch_size(users) or await forward_request(request, "user-v2", "/users/batch")
+
+@app.get("/users/v2", tags=["User Service V2"], summary="Get Many Users by ID (V2)")
+async def get_users_v2(ids: str, request: Request):
+    """Fetch several V2 users in one round trip: ?ids=id1,id2,..."""
+    return await forward_request(request, "user-v2", "/users")
 
 @app.put("/users/v2/{userId}/email", tags=["User Service V2"], summary="Update User Email (V2)")
-async def update_user_email_v2(userId: str, data: UpdateEmailV2):
+async def update_user_email_v2(userId: str, data: UpdateEmailV2, request: Request):
     """Update user email in V2 service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{USER_V2_URL}/users/{userId}/email", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "user-v2", f"/users/{userId}/email")
+    cache.invalidate_tag(f"user:{userId}")
+    return response
 
 @app.put("/users/v2/{userId}/address", tags=["User Service V2"], summary="Update User Address (V2)")
-async def update_user_address_v2(userId: str, data: UpdateAddressV2):
+async def update_user_address_v2(userId: str, data: UpdateAddressV2, request: Request):
     """Update user address in V2 service (structured: street, city, postal)"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{USER_V2_URL}/users/{userId}/address", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "user-v2", f"/users/{userId}/address")
+    cache.invalidate_tag(f"user:{userId}")
+    return response
 
 @app.get("/users/v2/{userId}", tags=["User Service V2"], summary="Get User by ID (V2)")
-async def get_user_v2(userId: str):
+async def get_user_v2(userId: str, request: Request):
     """Get user details by userId from V2 service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_V2_URL}/users/{userId}")
-        return response.json()
+    return await cached_get(
+        request,
+        lambda: upstreams["user-v2"].request("GET", f"/users/{userId}"),
+        [f"user:{userId}"]
+    )
 
 # =============================================================================
 # USER SERVICE - AUTO ROUTING (Strangler Pattern: 70% V1, 30% V2)
@@ -185,73 +557,226 @@ async def create_user_auto(request: Request):
     - 30% traffic goes to User Service V2
     
     Use /users/v1 or /users/v2 for explicit version routing.
+
+    Clients sending the same X-Routing-Key header (or routing_key cookie)
+    always land on the same version; the split is live-reloaded from
+    gateway-config.json. Traffic shifts away from a version that is failing
+    or slow, and a create that cannot reach its version goes to the other.
     """
-    random_number = random.randint(0, 99)
+    version = router.choose(request)
+    # Buffered rather than streamed, so it can be resent to the other version
     body = await request.body()
-    
-    if random_number < USER_V1_PERCENT:
-        forward_to = f"{USER_V1_URL}/users"
-        version = "V1"
-    else:
-        forward_to = f"{USER_V2_URL}/users"
-        version = "V2"
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(forward_to, content=body, headers=dict(request.headers))
-        result = response.json()
-        result["routed_to"] = version
-        return result
+    headers = proxy_headers(request.headers)
+
+    # The only handler that has to parse the upstream body, to inject routed_to
+    try:
+        try:
+            response = await user_request(version, "POST", "/users", content=body, headers=headers)
+        except (CircuitOpenError, httpx.ConnectError):
+            # Never reached the service, so the user cannot have been created there
+            version = OTHER_VERSION[version]
+            response = await user_request(version, "POST", "/users", content=body, headers=headers)
+    except Exception as e:
+        return gateway_error(e)
+    remember_created(response, version)
+    result = response_json(response)
+    if not isinstance(result, dict):
+        return buffered_response(response)
+    result["routed_to"] = version
+    return JSONResponse(content=result, status_code=response.status_code)
+
+@app.get("/users/{userId}", tags=["User Auto-Routing"], summary="Get User by ID (Auto-routed to owning version)")
+async def get_user_auto(userId: str, request: Request):
+    """
+    Reads a user from whichever version owns it. Users created through the
+    gateway are remembered and fetched in one hop; unknown ids are looked up
+    on V1 first, then V2, and the owner is remembered for next time.
+    """
+    return await cached_get(request, lambda: fetch_user(userId), [f"user:{userId}"])
 
 # =============================================================================
 # ORDER SERVICE ENDPOINTS
 # =============================================================================
 
 @app.post("/orders", tags=["Order Service"], summary="Create Order")
-async def create_order(order: OrderCreate):
+async def create_order(order: OrderCreate, request: Request):
     """Create a new order"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{ORDER_URL}/orders", json=order.dict())
-        return response.json()
+    return await forward_request(request, "order", "/orders")
+
+@app.post("/orders/batch", tags=["Order Service"], summary="Create Orders in Bulk")
+async def create_orders(orders: List[OrderCreate], request: Request):
+    """Create many orders with one insert; per-item failures are listed under `errors`"""
+    return check_batch_size(orders) or await forward_request(request, "order", "/orders/batch")
+
+@app.get("/orders", tags=["Order Service"], summary="List Orders")
+async def list_orders(request: Request, status: Optional[str] = None, userId: Optional[str] = None,
+                      limit: Optional[int] = None, cursor: Optional[str] = None, ids: Optional[str] = None):
+    """
+    List orders newest first, optionally filtered by status and/or userId.
+    Pages are capped by the order service; pass the returned nextCursor as
+    `cursor` to fetch the next page.
+
+    With `ids=id1,id2,...` returns exactly those orders in one round trip.
+    """
+    return await forward_request(request, "order", "/orders")
+
+@app.get("/orders/export", tags=["Order Service"], summary="Export Orders (NDJSON)")
+async def export_orders(request: Request, status: Optional[str] = None, userId: Optional[str] = None):
+    """Stream every matching order as newline-delimited JSON"""
+    return await forward_request(request, "order", "/orders/export")
+
+@app.get("/orders/details", tags=["Order Service"], summary="Get Many Orders with Their Users")
+async def get_orders_with_users(ids: str):
+    """
+    Batch form of /orders/{orderId}/details: ?ids=id1,id2,... Orders come from
+    one multi-get; their distinct users are then fetched concurrently, at most
+    `composition.max_concurrency` at a time.
+    """
+    order_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    too_large = check_batch_size(order_ids)
+    if too_large:
+        return too_large
+
+    try:
+        response = await upstreams["order"].request("GET", "/orders", params={"ids": ",".join(order_ids)})
+    except Exception as e:
+        return gateway_error(e)
+    result = response_json(response)
+    if response.status_code != 200 or "orders" not in result:
+        return buffered_response(response)
+
+    limit = asyncio.Semaphore(COMPOSE_CONCURRENCY)
+
+    async def bounded_load_user(userId):
+        async with limit:
+            return await load_user(userId)
+
+    user_ids = list(dict.fromkeys(order["userId"] for order in result["orders"]))
+    loaded = await asyncio.gather(*(bounded_load_user(u) for u in user_ids), return_exceptions=True)
+    users = {}
+    for userId, outcome in zip(user_ids, loaded):
+        # a user that is missing or could not be reached is embedded as null
+        if not isinstance(outcome, BaseException) and outcome[0] == 200:
+            users[userId] = outcome[1]
+
+    return {
+        "orders": [{**order, "user": users.get(order["userId"])} for order in result["orders"]],
+        "missing": result["missing"]
+    }
+
+@app.post("/orders/claim", tags=["Order Service"], summary="Claim Orders for Fulfillment")
+async def claim_orders(data: ClaimOrders, request: Request):
+    """
+    Lease the oldest unclaimed orders in `status` (default PENDING) to a worker.
+    Pass the returned leaseToken with the status update that finishes each one;
+    orders not moved on before leaseExpiresAt can be claimed by another worker.
+    """
+    return await forward_request(request, "order", "/orders/claim")
 
-# @app.get("/orders", tags=["Order Service"], summary="List Orders")
-# async def list_orders(status: Optional[str] = None):
-#     """List all orders, optionally filter by status (PENDING, COMPLETED, etc.)"""
-#     async with httpx.AsyncClient() as client:
-#         params = {"status": status} if status else {}
-#         response = await client.get(f"{ORDER_URL}/orders", params=params)
-#         return response.json()
+@app.post("/orders/release", tags=["Order Service"], summary="Release Claimed Orders")
+async def release_orders(data: ReleaseOrders, request: Request):
+    """Hand back every order still leased under a leaseToken"""
+    return await forward_request(request, "order", "/orders/release")
 
 @app.put("/orders/{orderId}/status", tags=["Order Service"], summary="Update Order Status")
-async def update_order_status(orderId: str, data: UpdateStatus):
-    """Update order status (PENDING, PROCESSING, SHIPPED, DELIVERED, CANCELLED)"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{ORDER_URL}/orders/{orderId}/status", json=data.dict())
-        return response.json()
+async def update_order_status(orderId: str, data: UpdateStatus, request: Request):
+    """
+    Update order status. Allowed moves: PENDING -> PROCESSING | CANCELLED,
+    PROCESSING -> SHIPPED | CANCELLED, SHIPPED -> DELIVERED; anything else is a 409.
+    """
+    response = await forward_request(request, "order", f"/orders/{orderId}/status")
+    cache.invalidate_tag(f"order:{orderId}")
+    return response
 
 @app.put("/orders/{orderId}/email", tags=["Order Service"], summary="Update Order Email")
-async def update_order_email(orderId: str, data: UpdateOrderEmail):
+async def update_order_email(orderId: str, data: UpdateOrderEmail, request: Request):
     """Update email for an order"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{ORDER_URL}/orders/{orderId}/email", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "order", f"/orders/{orderId}/email")
+    cache.invalidate_tag(f"order:{orderId}")
+    return response
 
 @app.put("/orders/{orderId}/address", tags=["Order Service"], summary="Update Order Delivery Address")
-async def update_order_address(orderId: str, data: UpdateOrderAddress):
+async def update_order_address(orderId: str, data: UpdateOrderAddress, request: Request):
     """Update delivery address for an order"""
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{ORDER_URL}/orders/{orderId}/address", json=data.dict())
-        return response.json()
+    response = await forward_request(request, "order", f"/orders/{orderId}/address")
+    cache.invalidate_tag(f"order:{orderId}")
+    return response
 
 @app.get("/orders/{orderId}", tags=["Order Service"], summary="Get Order by ID")
-async def get_order(orderId: str):
+async def get_order(orderId: str, request: Request):
     """Get order details by orderId"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{ORDER_URL}/orders/{orderId}")
-        return response.json()
+    return await cached_get(
+        request,
+        lambda: upstreams["order"].request("GET", f"/orders/{orderId}"),
+        order_tags(orderId)
+    )
+
+@app.get("/orders/{orderId}/details", tags=["Order Service"], summary="Get Order with Its User")
+async def get_order_with_user(orderId: str, userId: Optional[str] = None):
+    """
+    The order with its owning user embedded under `user` (null if the user
+    no longer exists or could not be reached), read from whichever user
+    version owns it. Pass the userId when it is already known to fetch both at
+    the same time instead of one after the other. Only a failure to load the
+    order fails the request.
+    """
+    user_part = None
+    if userId:
+        order_part, user_part = await asyncio.gather(load_order(orderId), load_user(userId), return_exceptions=True)
+    else:
+        order_part, = await asyncio.gather(load_order(orderId), return_exceptions=True)
+    if isinstance(order_part, BaseException):
+        return gateway_error(order_part)
+    status, order = order_part
+    if status != 200:
+        return JSONResponse(status_code=status, content=order)
+
+    # No hint, or the hint named someone else: look up the actual owner
+    if user_part is None or order["userId"] != userId:
+        try:
+            user_part = await load_user(order["userId"])
+        except Exception as e:
+            user_part = e
+
+    if isinstance(user_part, BaseException):
+        return {**order, "user": None}
+    user_status, user = user_part
+    return {**order, "user": user if user_status == 200 else None}
+
+
+# Upstream pool utilization
+
+@app.get("/metrics/upstreams", tags=["Gateway"], summary="Upstream Connection Pool Metrics")
+async def upstream_metrics():
+    """Keep-alive pool usage and request counters per upstream service"""
+    return upstreams.stats()
+
+@app.get("/metrics/routing", tags=["Gateway"], summary="Strangler Routing State")
+async def routing_metrics():
+    """Current V1/V2 split and size of the user ownership index"""
+    return router.stats()
+
+@app.get("/metrics/cache", tags=["Gateway"], summary="Response Cache Metrics")
+async def cache_metrics():
+    """Hit/miss counters and memory use of the GET response cache"""
+    return cache.stats()
+
+@app.get("/metrics/rate-limits", tags=["Gateway"], summary="Rate Limiter Metrics")
+async def rate_limit_metrics():
+    """Requests let through vs. rejected with 429 by the per-client rate limiter"""
+    return rate_limiter.stats()
+
+@app.get("/metrics/singleflight", tags=["Gateway"], summary="Request Coalescing Metrics")
+async def singleflight_metrics():
+    """Upstream GETs issued vs. calls saved by sharing an in-flight request"""
+    return singleflight.stats()
 
 
 # Health check FOR AWS
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    """The gateway itself is up; `circuits` shows which upstreams it is failing fast for."""
+    circuits = upstreams.circuits()
+    degraded = any(state != "closed" for state in circuits.values())
+    return {"status": "degraded" if degraded else "ok", "circuits": circuits}
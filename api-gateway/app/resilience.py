@@ -0,0 +1,155 @@
+import logging
+import time
+import random
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# Upstream resilience
+# -----------------------------
+# A circuit breaker per upstream stops the gateway from piling requests onto
+# a service that is down or hanging: after enough consecutive failures calls
+# fail fast for a while, then a few probe requests decide whether to close it
+# again. Idempotent requests that fail are retried with jittered exponential
+# backoff, but only while the retry budget allows, so retries can never turn
+# an outage into a multiple of the normal load.
+
+DEFAULT_RESILIENCE_SETTINGS = {
+    "failure_threshold": 5,
+    "open_seconds": 10.0,
+    "half_open_probes": 1,
+    "max_retries": 2,
+    "backoff_base": 0.05,
+    "backoff_max": 1.0,
+    "retry_budget_ratio": 0.2,
+    "retry_budget_min_per_second": 5,
+    "retry_budget_window": 10.0
+}
+
+# Methods safe to send twice
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Upstream replies worth retrying; also the ones that count against the breaker
+RETRYABLE_STATUS = {502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit for {name} is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.failure_threshold = settings["failure_threshold"]
+        self.open_seconds = settings["open_seconds"]
+        self.half_open_probes = settings["half_open_probes"]
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now."""
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = self.HALF_OPEN
+            self.probes = 0
+
+        if self.state == self.HALF_OPEN:
+            if self.probes >= self.half_open_probes:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.open_seconds)
+            self.probes += 1
+
+    def on_success(self):
+        self.failures = 0
+        if self.state == self.HALF_OPEN:
+            logger.info(f"Circuit for {self.name} closed")
+            self.state = self.CLOSED
+
+    def on_abandoned(self):
+        # the call was cancelled before it told us anything; free its probe slot
+        if self.state == self.HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def on_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        if self.state != self.OPEN:
+            logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.times_opened += 1
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+
+class RetryBudget:
+    """Allow retries up to a fraction of recent requests, plus a small floor per second."""
+
+    def __init__(self, settings):
+        self.ratio = settings["retry_budget_ratio"]
+        self.min_per_second = settings["retry_budget_min_per_second"]
+        self.window = settings["retry_budget_window"]
+        self.requests = deque()
+        self.retries = deque()
+        self.exhausted = 0
+
+    def _trim(self, now):
+        cutoff = now - self.window
+        for events in (self.requests, self.retries):
+            while events and events[0] < cutoff:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        self._trim(now)
+        self.requests.append(now)
+
+    def try_spend(self):
+        now = time.monotonic()
+        self._trim(now)
+        allowed = self.min_per_second * self.window + self.ratio * len(self.requests)
+        if len(self.retries) >= allowed:
+            self.exhausted += 1
+            return False
+        self.retries.append(now)
+        return True
+
+    def stats(self):
+        self._trim(time.monotonic())
+        return {
+            "recent_requests": len(self.requests),
+            "recent_retries": len(self.retries),
+            "exhausted": self.exhausted
+        }
+
+
+def backoff_delay(attempt, settings):
+    """Full-jitter exponential backoff for the given retry attempt (1-based)."""
+    cap = min(settings["backoff_max"], settings["backoff_base"] * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
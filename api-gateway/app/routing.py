@@ -0,0 +1,214 @@
+import logging
+import os
+import json
+import time
+import random
+import hashlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# Strangler routing engine
+# -----------------------------
+# Picks V1 or V2 by hashing a stable routing key onto the 0-99 range, so the
+# same client always lands on the same version, and remembers which version
+# owns each created user so reads go straight to the right service.
+#
+# Latency and error rate of each version are tracked as EWMAs. While one
+# version is unhealthy and the other is not, new users are steered away from
+# it (it keeps a small share so it can prove it has recovered); when both are
+# healthy, or both are not, the configured split applies.
+
+UPSTREAM_FOR_VERSION = {"V1": "user-v1", "V2": "user-v2"}
+
+DEFAULT_ROUTING_SETTINGS = {
+    "key_header": "X-Routing-Key",
+    "key_cookie": "routing_key",
+    "ownership_cache_size": 100000,
+    "reload_interval": 2.0,
+    "health_alpha": 0.2,
+    "max_error_rate": 0.5,
+    "max_latency": 1.0,
+    "unhealthy_traffic_share": 0.1,
+    "hedge_reads": True,
+    "hedge_delay": 0.05
+}
+
+OTHER_VERSION = {"V1": "V2", "V2": "V1"}
+
+# Both versions store users in one collection, so either may find a user of
+# the other; a field only its own schema has tells the owner apart.
+SCHEMA_FIELD = {"V1": "deliveryAddress", "V2": "firstName"}
+
+
+def hash_bucket(key):
+    """Map a routing key onto a stable bucket in 0-99."""
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % 100
+
+
+class OwnershipIndex:
+    """Bounded LRU map of userId -> owning version."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.owners = OrderedDict()
+
+    def get(self, user_id):
+        version = self.owners.get(user_id)
+        if version is not None:
+            self.owners.move_to_end(user_id)
+        return version
+
+    def set(self, user_id, version):
+        self.owners[user_id] = version
+        self.owners.move_to_end(user_id)
+        while len(self.owners) > self.max_size:
+            self.owners.popitem(last=False)
+
+    def __len__(self):
+        return len(self.owners)
+
+
+class VersionHealth:
+    """Exponentially weighted moving averages of one version's latency and error rate."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.samples = 0
+
+    def record(self, latency, ok):
+        if self.samples == 0:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        self.samples += 1
+
+    def stats(self):
+        return {
+            "latency_ewma": round(self.latency, 4),
+            "error_rate_ewma": round(self.error_rate, 4),
+            "samples": self.samples
+        }
+
+
+class StranglerRouter:
+    def __init__(self, config_path, config):
+        self.config_path = config_path
+        self.settings = {**DEFAULT_ROUTING_SETTINGS, **config.get("routing", {})}
+        self.v1_percent = config["user_v1_percentage"]
+        self.ownership = OwnershipIndex(self.settings["ownership_cache_size"])
+        self.health = {version: VersionHealth(self.settings["health_alpha"]) for version in UPSTREAM_FOR_VERSION}
+
+        self._mtime = self._config_mtime()
+        self._last_check = time.monotonic()
+        self.reloads = 0
+        self.hedged = 0
+
+    # ---- live reload of the V1/V2 split ----
+
+    def _config_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return None
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._last_check < self.settings["reload_interval"]:
+            return
+        self._last_check = now
+
+        mtime = self._config_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+
+        try:
+            with open(self.config_path, "r") as f:
+                percent = int(json.load(f)["user_v1_percentage"])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not reload {self.config_path}, keeping {self.v1_percent}% V1: {e}")
+            return
+
+        if not 0 <= percent <= 100:
+            logger.warning(f"Ignoring user_v1_percentage={percent}, must be between 0 and 100")
+            return
+
+        if percent != self.v1_percent:
+            logger.info(f"Strangler split reloaded: {self.v1_percent}% -> {percent}% V1")
+            self.v1_percent = percent
+            self.reloads += 1
+
+    # ---- version selection ----
+
+    def routing_key(self, request):
+        key = request.headers.get(self.settings["key_header"])
+        if not key:
+            key = request.cookies.get(self.settings["key_cookie"])
+        return key
+
+    def choose(self, request):
+        """Return "V1" or "V2" for a new user."""
+        self.reload_if_changed()
+        key = self.routing_key(request)
+        bucket = hash_bucket(key) if key else random.randint(0, 99)
+        return "V1" if bucket < self.effective_v1_percent() else "V2"
+
+    # ---- version health ----
+
+    def record(self, version, latency, ok):
+        self.health[version].record(latency, ok)
+
+    def healthy(self, version):
+        health = self.health[version]
+        return (health.error_rate < self.settings["max_error_rate"]
+                and health.latency < self.settings["max_latency"])
+
+    def effective_v1_percent(self):
+        """The configured split, unless exactly one version is unhealthy."""
+        v1_healthy, v2_healthy = self.healthy("V1"), self.healthy("V2")
+        if v1_healthy == v2_healthy:
+            return self.v1_percent
+        share = self.settings["unhealthy_traffic_share"]
+        if not v1_healthy:
+            return self.v1_percent * share
+        return 100 - (100 - self.v1_percent) * share
+
+    def probe_order(self):
+        """Versions to look an unknown user up in: V1 first unless only V2 is healthy."""
+        if not self.healthy("V1") and self.healthy("V2"):
+            return ["V2", "V1"]
+        return ["V1", "V2"]
+
+    def hedge_delay(self, version):
+        """Seconds to wait on `version` before also asking the other one (None = never)."""
+        if not self.settings["hedge_reads"]:
+            return None
+        if not self.healthy(version):
+            return 0
+        return self.settings["hedge_delay"]
+
+    def owner(self, user_id):
+        return self.ownership.get(user_id)
+
+    def remember(self, user_id, version):
+        self.ownership.set(user_id, version)
+
+    def stats(self):
+        return {
+            "user_v1_percentage": self.v1_percent,
+            "effective_v1_percentage": round(self.effective_v1_percent(), 2),
+            "health": {
+                version: {**health.stats(), "healthy": self.healthy(version)}
+                for version, health in self.health.items()
+            },
+            "hedged_reads": self.hedged,
+            "config_reloads": self.reloads,
+            "known_owners": len(self.ownership),
+            "ownership_cache_size": self.ownership.max_size
+        }
@@ -0,0 +1,72 @@
+import asyncio
+
+# -----------------------------
+# Request coalescing
+# -----------------------------
+# Concurrent callers asking for the same key share one in-flight upstream
+# call instead of each issuing their own. The call runs as its own task, so a
+# client disconnecting does not cancel it for everyone else waiting on it.
+
+DEFAULT_SINGLE_FLIGHT_SETTINGS = {
+    "enabled": True,
+    "max_waiters": 1000
+}
+
+
+class Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, settings):
+        self.settings = {**DEFAULT_SINGLE_FLIGHT_SETTINGS, **settings}
+        self.enabled = self.settings["enabled"]
+        self.max_waiters = self.settings["max_waiters"]
+        self.flights = {}
+
+        self.leaders = 0
+        self.shared = 0
+        self.overflow = 0
+
+    async def do(self, key, fn):
+        """Return the result of `await fn()`, sharing it with concurrent calls for `key`."""
+        if not self.enabled:
+            return await fn()
+
+        flight = self.flights.get(key)
+        if flight is not None:
+            if flight.waiters < self.max_waiters:
+                flight.waiters += 1
+                self.shared += 1
+                return await asyncio.shield(flight.task)
+            # Too many followers on this key already; go upstream separately
+            self.overflow += 1
+            return await fn()
+
+        task = asyncio.ensure_future(fn())
+        flight = Flight(task)
+        self.flights[key] = flight
+        task.add_done_callback(lambda _: self._finish(key, flight))
+        self.leaders += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        # Mark a failure as retrieved even if every waiter has gone away
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.flights),
+            "max_waiters": self.max_waiters,
+            "upstream_calls": self.leaders,
+            "calls_saved": self.shared,
+            "waiter_overflow": self.overflow
+        }
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import random
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from fastapi import Request
+
+# -----------------------------
+# Distributed tracing
+# -----------------------------
+# W3C traceparent over HTTP and AMQP headers; finished spans on GET /traces (if served) and TRACE_FILE.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# Not worth a span each
+UNTRACED_PATHS = {"/health", "/ready", "/metrics", "/traces"}
+
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "sampled"])
+
+current_context = ContextVar("current_context", default=None)
+service_name = "unknown"
+
+
+def parse_traceparent(value):
+    """SpanContext from a `traceparent` value, or None if it is missing or malformed."""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], sampled)
+
+
+def format_traceparent(context):
+    return f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+
+
+def new_context(parent=None):
+    """A fresh span id in `parent`'s trace, or the root of a new, possibly sampled, trace."""
+    span_id = f"{random.getrandbits(64):016x}"
+    if parent is not None:
+        return SpanContext(parent.trace_id, span_id, parent.sampled)
+    return SpanContext(f"{random.getrandbits(128):032x}", span_id, random.random() < TRACE_SAMPLE_RATE)
+
+
+def inject(headers=None):
+    """Copy of `headers` carrying the current trace context, if there is one."""
+    headers = dict(headers or {})
+    context = current_context.get()
+    if context is not None:
+        headers["traceparent"] = format_traceparent(context)
+    return headers
+
+
+def current_traceparent():
+    context = current_context.get()
+    return format_traceparent(context) if context is not None else None
+
+
+class Collector:
+    """Keeps the most recent finished spans in memory, optionally mirroring them to a file."""
+
+    def __init__(self, size=TRACE_BUFFER_SIZE, path=TRACE_FILE):
+        self.spans = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.file = open(path, "a", buffering=1) if path else None
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if self.file is not None:
+                self.file.write(json.dumps(span) + "\n")
+
+    def find(self, trace_id=None, limit=100):
+        with self.lock:
+            spans = list(self.spans)
+        if trace_id:
+            spans = [s for s in spans if s["traceId"] == trace_id]
+        return spans[-limit:]
+
+
+collector = Collector()
+
+
+def record(name, context, parent_id, start, end, **attributes):
+    """Export a finished span with explicit timings (for spans that cross threads)."""
+    if not TRACING_ENABLED or context is None or not context.sampled:
+        return
+    collector.export({
+        "traceId": context.trace_id,
+        "spanId": context.span_id,
+        "parentId": parent_id,
+        "service": service_name,
+        "name": name,
+        "start": start,
+        "durationMs": round((end - start) * 1000, 3),
+        "attributes": attributes
+    })
+
+
+class Span:
+    __slots__ = ("name", "context", "attributes")
+
+    def __init__(self, name, context, attributes):
+        self.name = name
+        self.context = context
+        self.attributes = attributes
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """Run the block as a span, a child of `parent` (default: the current span)."""
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    parent = parent if parent is not None else current_context.get()
+    current = Span(name, new_context(parent), attributes)
+    token = current_context.set(current.context)
+    start = time.time()
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        current_context.reset(token)
+        record(current.name, current.context, parent.span_id if parent else None, start, time.time(),
+               **current.attributes)
+
+
+def trace_requests(app, service, serve_traces=True):
+    """Open a server span for every request, continuing the caller's trace, and serve GET /traces unless told not to."""
+    global service_name
+    service_name = service
+
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        if not TRACING_ENABLED or request.url.path in UNTRACED_PATHS:
+            return await call_next(request)
+
+        parent = parse_traceparent(request.headers.get("traceparent"))
+        with span(f"{request.method} {request.url.path}", parent=parent) as server:
+            response = await call_next(request)
+            route = request.scope.get("route")
+            if route is not None:
+                server.name = f"{request.method} {route.path}"
+            server.attributes["status_code"] = response.status_code
+            response.headers["traceparent"] = format_traceparent(server.context)
+            return response
+
+    if not serve_traces:
+        return
+
+    @app.get("/traces", include_in_schema=False)
+    async def traces(traceId: Optional[str] = None, limit: int = 100):
+        return collector.find(traceId, limit)
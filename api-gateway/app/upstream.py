@@ -0,0 +1,278 @@
+import logging
+import time
+import asyncio
+import httpx
+from .resilience import (
+    DEFAULT_RESILIENCE_SETTINGS, IDEMPOTENT_METHODS, RETRYABLE_STATUS,
+    CircuitBreaker, RetryBudget, backoff_delay
+)
+from .admission import DEFAULT_CONCURRENCY_SETTINGS, ConcurrencyLimiter
+from .metrics import registry
+from .tracing import span, inject
+from .logs import with_request_id
+
+logger = logging.getLogger(__name__)
+
+upstream_request_seconds = registry.histogram(
+    "gateway_upstream_request_duration_seconds", "Time to the response headers of each upstream attempt",
+    ["upstream", "method", "status"]
+)
+
+# -----------------------------
+# Upstream connection pools
+# -----------------------------
+# One long-lived httpx.AsyncClient per upstream service, so proxied calls
+# reuse keep-alive connections instead of opening a new socket per request.
+
+DEFAULT_POOL_SETTINGS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "connect_timeout": 2.0,
+    "read_timeout": 10.0,
+    "write_timeout": 10.0,
+    "pool_timeout": 5.0,
+    "http2": False
+}
+
+# Headers that describe a single connection and must not be forwarded (RFC 7230 6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host"
+}
+
+
+def proxy_headers(headers):
+    """Copy headers for the next hop, dropping hop-by-hop ones and any named in Connection."""
+    dropped = set(HOP_BY_HOP_HEADERS)
+    for token in headers.get("connection", "").split(","):
+        dropped.add(token.strip().lower())
+    return {key: value for key, value in headers.items() if key.lower() not in dropped}
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Upstream:
+    def __init__(self, name, base_url, settings, resilience=DEFAULT_RESILIENCE_SETTINGS,
+                 concurrency=DEFAULT_CONCURRENCY_SETTINGS):
+        self.name = name
+        self.base_url = base_url
+        self.settings = settings
+        self.resilience = resilience
+        self.client = None
+        self.breaker = CircuitBreaker(name, resilience)
+        self.budget = RetryBudget(resilience)
+        self.limiter = ConcurrencyLimiter(name, concurrency)
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.retries_total = 0
+
+    async def start(self):
+        s = self.settings
+        http2 = bool(s["http2"])
+        if http2 and not http2_available():
+            logger.warning(f"HTTP/2 requested for {self.name} but 'h2' is not installed, using HTTP/1.1")
+            http2 = False
+
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=s["max_connections"],
+                max_keepalive_connections=s["max_keepalive_connections"],
+                keepalive_expiry=s["keepalive_expiry"]
+            ),
+            timeout=httpx.Timeout(
+                connect=s["connect_timeout"],
+                read=s["read_timeout"],
+                write=s["write_timeout"],
+                pool=s["pool_timeout"]
+            )
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def request(self, method, path, headers=None, **kwargs):
+        return await self._call(
+            method, path, headers,
+            lambda headers: self.client.request(method, path, headers=headers, **kwargs)
+        )
+
+    async def send_stream(self, method, path, headers=None, **kwargs):
+        """Send a request and return the response unread; release it with close_stream()."""
+        return await self._call(
+            method, path, headers,
+            lambda headers: self.client.send(
+                self.client.build_request(method, path, headers=headers, **kwargs), stream=True
+            ),
+            stream=True,
+            # a streamed request body can only be sent once
+            retryable=kwargs.get("content") is None
+        )
+
+    async def _call(self, method, path, headers, send, stream=False, retryable=True):
+        """
+        Send through the circuit breaker (raises CircuitOpenError while it is
+        open) and the concurrency limiter (raises UpstreamOverloaded when no
+        slot frees up in time), retrying idempotent requests that fail or get
+        a 502/503/504 while attempts and the retry budget last. Each attempt
+        is a client span whose context is sent along in `traceparent`.
+        """
+        retryable = retryable and method.upper() in IDEMPOTENT_METHODS
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                await self.limiter.acquire()
+            except BaseException:
+                self.breaker.on_abandoned()
+                raise
+            self._enter()
+            started = time.perf_counter()
+            try:
+                with span(f"{method} {self.name}", path=path, attempt=attempt) as client_span:
+                    response = await send(with_request_id(inject(headers)))
+                    if client_span is not None:
+                        client_span.attributes["status_code"] = response.status_code
+            except Exception:
+                upstream_request_seconds.observe(
+                    time.perf_counter() - started, upstream=self.name, method=method, status="error"
+                )
+                self.errors_total += 1
+                self._exit()
+                self.breaker.on_failure()
+                if not self._may_retry(retryable, attempt):
+                    raise
+            except BaseException:
+                self._exit()
+                self.breaker.on_abandoned()
+                raise
+            else:
+                upstream_request_seconds.observe(
+                    time.perf_counter() - started, upstream=self.name, method=method, status=response.status_code
+                )
+                if response.status_code not in RETRYABLE_STATUS:
+                    self.breaker.on_success()
+                    if not stream:
+                        self._exit()
+                    return response
+                self.breaker.on_failure()
+                if not self._may_retry(retryable, attempt):
+                    if not stream:
+                        self._exit()
+                    return response
+                if stream:
+                    await response.aclose()
+                self._exit()
+
+            attempt += 1
+            self.retries_total += 1
+            await asyncio.sleep(backoff_delay(attempt, self.resilience))
+
+    def _may_retry(self, retryable, attempt):
+        return retryable and attempt < self.resilience["max_retries"] and self.budget.try_spend()
+
+    async def close_stream(self, response):
+        try:
+            await response.aclose()
+        finally:
+            self._exit()
+
+    def _enter(self):
+        self.requests_total += 1
+        self.in_flight += 1
+        if self.in_flight > self.peak_in_flight:
+            self.peak_in_flight = self.in_flight
+
+    def _exit(self):
+        self.in_flight -= 1
+        self.limiter.release()
+
+    def _pool_connections(self):
+        # httpx does not expose its connection pool publicly; read it defensively
+        transport = getattr(self.client, "_transport", None)
+        pool = getattr(transport, "_pool", None)
+        return list(getattr(pool, "connections", []))
+
+    def stats(self):
+        connections = self._pool_connections() if self.client is not None else []
+        idle = sum(1 for c in connections if c.is_idle())
+        max_connections = self.settings["max_connections"]
+        return {
+            "url": self.base_url,
+            "http2": bool(self.client and self.settings["http2"] and http2_available()),
+            "max_connections": max_connections,
+            "max_keepalive_connections": self.settings["max_keepalive_connections"],
+            "open_connections": len(connections),
+            "idle_connections": idle,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "utilization": round(self.in_flight / max_connections, 3) if max_connections else 0.0,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "retries_total": self.retries_total,
+            "circuit": self.breaker.stats(),
+            "retry_budget": self.budget.stats(),
+            "concurrency": self.limiter.stats()
+        }
+
+
+class UpstreamRegistry:
+    def __init__(self):
+        self.upstreams = {}
+
+    @classmethod
+    def from_config(cls, config, urls):
+        """Build one Upstream per name in `urls`, merging pool, resilience and concurrency settings from config."""
+        pool_config = config.get("upstream_pools", {})
+        defaults = {**DEFAULT_POOL_SETTINGS, **pool_config.get("defaults", {})}
+        resilience_config = config.get("resilience", {})
+        resilience_defaults = {**DEFAULT_RESILIENCE_SETTINGS, **resilience_config.get("defaults", {})}
+        concurrency_config = config.get("upstream_concurrency", {})
+        concurrency_defaults = {**DEFAULT_CONCURRENCY_SETTINGS, **concurrency_config.get("defaults", {})}
+
+        registry = cls()
+        for name, url in urls.items():
+            settings = {**defaults, **pool_config.get(name, {})}
+            resilience = {**resilience_defaults, **resilience_config.get(name, {})}
+            concurrency = {**concurrency_defaults, **concurrency_config.get(name, {})}
+            registry.upstreams[name] = Upstream(name, url, settings, resilience, concurrency)
+        return registry
+
+    def __getitem__(self, name):
+        return self.upstreams[name]
+
+    async def start(self):
+        for upstream in self.upstreams.values():
+            await upstream.start()
+
+    async def close(self):
+        for upstream in self.upstreams.values():
+            await upstream.close()
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+    def circuits(self):
+        return {name: upstream.breaker.state for name, upstream in self.upstreams.items()}
@@ -0,0 +1,178 @@
+"""
+Cold-start benchmark: how long each service takes from process start until
+it answers /health (listening) and /ready (MongoDB warmed up), plus how much
+of that is importing the app.
+
+Every run spawns a fresh `uvicorn` process for the service. By default
+MongoDB is mongomock and RabbitMQ unreachable, as in bench.py, so the numbers
+are our own import and startup work. Pass --real to use MONGO_URI and
+RABBITMQ_URL from the environment instead.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/coldstart.py --runs 5
+    python benchmarks/coldstart.py --service order-service --real --json
+    python benchmarks/coldstart.py --runs 5 --save-baseline coldstart
+
+Saved results go to benchmarks/baselines/, next to bench.py's baselines.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+SERVICES = ["api-gateway", "user-service-v1", "user-service-v2", "order-service"]
+
+
+# -----------------------------
+# Child: one service process
+# -----------------------------
+
+def serve(service, port, real):
+    started = time.perf_counter()
+    if not real:
+        # Sets the env defaults and swaps in mongomock before the app is imported
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import bench  # noqa: F401
+
+    directory = os.path.join(ROOT, service)
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+
+    import uvicorn
+    import_started = time.perf_counter()
+    from app.main import app
+    imported = time.perf_counter()
+
+    # The parent reads this line before polling
+    print(json.dumps({"setup": import_started - started, "import": imported - import_started}), flush=True)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+# -----------------------------
+# Parent: spawn and poll
+# -----------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def answers(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status == 200
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return False
+
+
+def wait_for(url, deadline, interval):
+    while time.perf_counter() < deadline:
+        if answers(url):
+            return True
+        time.sleep(interval)
+    return False
+
+
+def measure(service, real, timeout, interval):
+    """One cold start; seconds from spawn to each milestone (None if it never got there)."""
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), "--serve", service, "--port", str(port)]
+    if real:
+        command.append("--real")
+
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        deadline = started + timeout
+        line = process.stdout.readline()
+        timings = json.loads(line) if line else {}
+        result = {"import": timings.get("import"), "health": None, "ready": None}
+
+        base = f"http://127.0.0.1:{port}"
+        if wait_for(f"{base}/health", deadline, interval):
+            result["health"] = time.perf_counter() - started
+            if wait_for(f"{base}/ready", deadline, interval):
+                result["ready"] = time.perf_counter() - started
+        return result
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return {"median_ms": None, "max_ms": None}
+    return {
+        "median_ms": round(statistics.median(values) * 1000, 1),
+        "max_ms": round(max(values) * 1000, 1)
+    }
+
+
+def run(args):
+    report = {"settings": {"runs": args.runs, "real": args.real}, "services": {}}
+    for service in args.service or SERVICES:
+        results = [measure(service, args.real, args.timeout, args.interval) for _ in range(args.runs)]
+        report["services"][service] = {
+            milestone: {**summarize([r[milestone] for r in results]),
+                        "failed": sum(r[milestone] is None for r in results)}
+            for milestone in ("import", "health", "ready")
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'service':<18}{'milestone':<10}{'median ms':>11}{'max ms':>10}{'failed':>8}")
+    for service, milestones in report["services"].items():
+        for milestone, row in milestones.items():
+            median = "-" if row["median_ms"] is None else row["median_ms"]
+            maximum = "-" if row["max_ms"] is None else row["max_ms"]
+            print(f"{service:<18}{milestone:<10}{median:>11}{maximum:>10}{row['failed']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure service cold starts")
+    parser.add_argument("--service", action="append", choices=SERVICES, help="service to measure (repeatable)")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts per service")
+    parser.add_argument("--real", action="store_true", help="use the real MongoDB and RabbitMQ from the environment")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for /ready per run")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between polls")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store the results as benchmarks/baselines/NAME.json")
+    parser.add_argument("--serve", choices=SERVICES, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.real)
+        return
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response
+from pymongo.errors import DuplicateKeyError
+from . import repository
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# Conditional and idempotent writes
+# -----------------------------
+# If-Match checks against the document version, and Idempotency-Key replay of writes.
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+class VersionConflict(HTTPException):
+    def __init__(self, current):
+        super().__init__(412, "Resource was modified, fetch it again and retry",
+                         headers={"ETag": format_etag(current)})
+
+
+def format_etag(version, variant=None):
+    """`variant` distinguishes representations of one version (e.g. resolved read-time data)."""
+    return f'"{version}.{variant}"' if variant is not None else f'"{version}"'
+
+
+def parse_if_match(value):
+    """The version an If-Match header requires, or None when any version will do."""
+    if value is None or value.strip() == "*":
+        return None
+    tag = value.split(",")[0].strip().removeprefix("W/").strip('"')
+    try:
+        return int(tag.split(".")[0])
+    except ValueError:
+        raise HTTPException(412, "If-Match does not name a version of this resource")
+
+
+def version_filter(version):
+    """Filter clause matching documents at `version`."""
+    return {"version": version} if version else {"version": {"$in": [0, None]}}
+
+
+def versioned(body, version, variant=None, status_code=200):
+    return JSONResponse(body, status_code=status_code, headers={"ETag": format_etag(version, variant)})
+
+
+def request_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+async def idempotent(key, scope, payload, handler):
+    """
+    Run `await handler()` (which returns a Response) at most once per
+    Idempotency-Key `key` within `scope` (service, method and path; the
+    services share idempotency_keys). Without a key it just runs. `payload`
+    is the request body, to detect keys reused for another request.
+    """
+    if not key:
+        return await handler()
+
+    record_id = f"{scope} {key}"
+    fingerprint = request_hash(payload)
+    try:
+        await repository.idempotency.insert_one({
+            "_id": record_id,
+            "requestHash": fingerprint,
+            "status": "IN_PROGRESS",
+            "createdAt": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return await replay(record_id, fingerprint)
+
+    try:
+        response = await handler()
+    except HTTPException as e:
+        if e.status_code >= 500:
+            await repository.idempotency.delete_one({"_id": record_id})
+            raise
+        await store(record_id, JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers))
+        raise
+    except BaseException:
+        # Nothing to replay; let the client's retry run it again
+        await repository.idempotency.delete_one({"_id": record_id})
+        raise
+
+    await store(record_id, response)
+    return response
+
+
+async def store(record_id, response):
+    await repository.idempotency.update_one({"_id": record_id}, {"$set": {
+        "status": "DONE",
+        "statusCode": response.status_code,
+        "body": bytes(response.body),
+        "etag": response.headers.get("etag")
+    }})
+
+
+async def replay(record_id, fingerprint):
+    record = await repository.idempotency.find_one({"_id": record_id})
+    if record is None:
+        # Expired or abandoned between our insert and this read
+        raise HTTPException(409, "Request with this Idempotency-Key is being retried, try again")
+    if record["requestHash"] != fingerprint:
+        raise HTTPException(422, f"{IDEMPOTENCY_HEADER} was already used for a different request")
+    if record["status"] != "DONE":
+        raise HTTPException(409, "Request with this Idempotency-Key is still in progress")
+
+    headers = {"Idempotent-Replayed": "true"}
+    if record.get("etag"):
+        headers["ETag"] = record["etag"]
+    return Response(record["body"], status_code=record["statusCode"], headers=headers,
+                    media_type="application/json")
@@ -1,11 +1,54 @@
 from pymongo import MongoClient
 from dotenv import load_dotenv
 import os
+import threading
 
 load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+DB_NAME = "ecommerce_db"
 
-db = client["ecommerce_db"]
+# The client (and, for mongodb+srv URIs, its DNS lookups) is only built when a
+# collection is first used, so importing the app stays cheap and the process
+# can answer /health before MongoDB is reachable. The lifespan's warm-up
+# touches it first, off the request path.
+_client = None
+_client_lock = threading.Lock()
 
-orders_collection = db["orders_db"]
\ No newline at end of file
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+                                      connect=False)
+    return _client
+
+
+class LazyDatabase:
+    """Stands in for client[DB_NAME] until first used."""
+
+    def __getitem__(self, name):
+        return get_client()[DB_NAME][name]
+
+    def __getattr__(self, attribute):
+        return getattr(get_client()[DB_NAME], attribute)
+
+
+class LazyCollection:
+    """Stands in for db[name] until first used."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client()[DB_NAME][self.name], attribute)
+
+
+db = LazyDatabase()
+
+# This service's collections (the rest of the module is shared)
+orders_collection = LazyCollection("orders_db")
+users_snapshot_collection = LazyCollection("users_snapshot")
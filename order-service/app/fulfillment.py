@@ -0,0 +1,78 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+from . import repository
+
+# -----------------------------
+# Order status state machine
+# -----------------------------
+# status -> statuses an order in it may move to. update_status puts the
+# allowed source statuses in its find_one_and_update filter, so two concurrent
+# updates can never skip a step or revive a finished order.
+
+STATUS_TRANSITIONS = {
+    "PENDING": {"PROCESSING", "CANCELLED"},
+    "PROCESSING": {"SHIPPED", "CANCELLED"},
+    "SHIPPED": {"DELIVERED"},
+    "DELIVERED": set(),
+    "CANCELLED": set()
+}
+
+
+def sources(status):
+    """Statuses an order may move to `status` from."""
+    return [source for source, targets in STATUS_TRANSITIONS.items() if status in targets]
+
+
+# -----------------------------
+# Status queues for fulfillment workers
+# -----------------------------
+# A worker claims the oldest N unleased orders in a status. Each claim is one
+# atomic find_one_and_update on the status index, so parallel workers never
+# get the same order. The lease (owner, token, expiry) is cleared when the
+# order changes status. If a worker dies, its orders become claimable again
+# once the lease expires. A status update that passes the lease token only
+# applies while that lease is still held.
+
+CLAIM_MAX_SIZE = int(os.getenv("CLAIM_MAX_SIZE", "100"))
+CLAIM_LEASE_SECONDS = float(os.getenv("CLAIM_LEASE_SECONDS", "60"))
+CLAIM_MAX_LEASE_SECONDS = float(os.getenv("CLAIM_MAX_LEASE_SECONDS", "3600"))
+
+LEASE_FIELDS = ["leaseOwner", "leaseToken", "leaseExpiresAt"]
+
+# oldest first: the status index read backwards
+CLAIM_SORT = [("createdAt", 1), ("_id", 1)]
+
+
+def unleased(now):
+    return {"$or": [{"leaseExpiresAt": None}, {"leaseExpiresAt": {"$lte": now}}]}
+
+
+async def claim(status, limit, worker, lease_seconds, projection):
+    """Lease up to `limit` orders in `status`; returns (token, expiresAt, orders)."""
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+    expires_at = (now + timedelta(seconds=lease_seconds)).isoformat()
+
+    claimed = []
+    for _ in range(limit):
+        order = await repository.orders.find_one_and_update(
+            {"status": status, **unleased(now.isoformat())},
+            {"$set": {"leaseOwner": worker, "leaseToken": token, "leaseExpiresAt": expires_at}},
+            projection=projection,
+            sort=CLAIM_SORT,
+            return_document=True
+        )
+        if not order:
+            break
+        claimed.append(order)
+    return token, expires_at, claimed
+
+
+async def release(token):
+    """Give back every order still leased under `token`; returns how many."""
+    result = await repository.orders.update_many(
+        {"leaseToken": token},
+        {"$unset": {field: "" for field in LEASE_FIELDS}}
+    )
+    return result.modified_count
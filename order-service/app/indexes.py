@@ -0,0 +1,94 @@
+import logging
+import os
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+from .database import db
+from .conditional import IDEMPOTENCY_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CHECK_QUERY_PLANS = os.getenv("CHECK_QUERY_PLANS", "false").lower() == "true"
+
+# -----------------------------
+# Declarative index spec
+# -----------------------------
+# collection -> indexes it must have. ensure_indexes() creates any that are
+# missing at startup (create_indexes is a no-op for ones that already exist).
+
+INDEXES = {
+    "orders_db": [
+        # consumer's update_many({"userId": ...}) on every UserUpdated event,
+        # and GET /orders?userId=... pages, newest first
+        IndexModel([("userId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="userId_1_createdAt_-1__id_-1"),
+        # GET /orders?status=... pages, newest first, and POST /orders/claim, oldest first
+        IndexModel([("status", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="status_1_createdAt_-1__id_-1"),
+        # unfiltered GET /orders pages
+        IndexModel([("createdAt", DESCENDING), ("_id", DESCENDING)], name="createdAt_-1__id_-1")
+    ],
+    "idempotency_keys": [
+        # Idempotency-Key records expire once clients can no longer be retrying
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_1", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    ]
+}
+
+# Representative shapes of every query this service runs, checked with explain
+ORDERS_SORT = {"createdAt": -1, "_id": -1}
+QUERY_SHAPES = [
+    {"name": "get order by id", "collection": "orders_db", "filter": {"_id": ObjectId()}},
+    {"name": "orders of a user (consumer update_many)", "collection": "orders_db", "filter": {"userId": ""}},
+    {"name": "list orders", "collection": "orders_db", "filter": {}, "sort": ORDERS_SORT},
+    {"name": "list orders by status", "collection": "orders_db",
+     "filter": {"status": "PENDING"}, "sort": ORDERS_SORT},
+    {"name": "claim orders by status", "collection": "orders_db",
+     "filter": {"status": "PENDING", "$or": [{"leaseExpiresAt": None}, {"leaseExpiresAt": {"$lte": ""}}]},
+     "sort": {"createdAt": 1, "_id": 1}},
+    {"name": "list orders by user", "collection": "orders_db",
+     "filter": {"userId": ""}, "sort": ORDERS_SORT}
+]
+
+
+def ensure_indexes():
+    created = {}
+    for collection, indexes in INDEXES.items():
+        try:
+            created[collection] = db[collection].create_indexes(indexes)
+        except PyMongoError as e:
+            logger.error(f"Could not create indexes on {collection}: {e}")
+            created[collection] = []
+    return created
+
+
+def plan_stages(plan):
+    """Yield every stage name in an explain plan tree."""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        yield from plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+def check_query_plans():
+    """Explain each query shape and report which ones would scan the whole collection."""
+    report = []
+    for shape in QUERY_SHAPES:
+        command = {"find": shape["collection"], "filter": shape["filter"]}
+        if "sort" in shape:
+            command["sort"] = shape["sort"]
+        try:
+            explained = db.command("explain", command, verbosity="queryPlanner")
+        except PyMongoError as e:
+            report.append({"query": shape["name"], "error": str(e)})
+            continue
+
+        stages = list(plan_stages(explained.get("queryPlanner", {}).get("winningPlan")))
+        collscan = "COLLSCAN" in stages
+        if collscan:
+            logger.warning(f"Query '{shape['name']}' does a COLLSCAN on {shape['collection']}")
+        report.append({"query": shape["name"], "stages": stages, "collscan": collscan})
+    return report
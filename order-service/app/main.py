@@ -1,28 +1,97 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
 from datetime import datetime
-from .database import orders_collection
-from .schemas import OrderCreate, UpdateStatus, UpdateEmail, UpdateAddress, OrderItem
+from typing import List, Optional
+import os
+import json
+import base64
+import zlib
+import asyncio
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from .schemas import OrderCreate, UpdateStatus, UpdateEmail, UpdateAddress, OrderItem, ClaimOrders, ReleaseOrders
+from . import repository
+from .conditional import idempotent, parse_if_match, version_filter, versioned, VersionConflict
+from .fulfillment import STATUS_TRANSITIONS, LEASE_FIELDS, CLAIM_MAX_SIZE, CLAIM_LEASE_SECONDS, \
+    CLAIM_MAX_LEASE_SECONDS, sources, claim, release
+from .read_model import resolve_contacts, current_contact, cache as snapshot_cache, USER_READ_MODEL, FROZEN_STATUSES
+from .indexes import ensure_indexes, check_query_plans, CHECK_QUERY_PLANS
+from .database import db
+from .consumer import runner as consumer, stats as consumer_stats
+from .readiness import add_check, warm_up, serve_readiness
+from .metrics import instrument
+from .tracing import trace_requests
+from .logs import setup_logging, log_requests
 
-app = FastAPI(title="Order Service v1", version="1.0")
+setup_logging("order-service")
 
+def prepare_database():
+    db.command("ping")
+    ensure_indexes()
+    if CHECK_QUERY_PLANS:
+        check_query_plans()
 
-def serialize_order(order):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # MongoDB is warmed up and RabbitMQ connected in the background; /ready
+    # reports when the database is. Orders can be served while the consumer is
+    # still (re)connecting, so that check does not hold readiness back.
+    warming = asyncio.create_task(warm_up("mongo", prepare_database))
+    consumer.start()
+    add_check("rabbitmq", lambda: consumer.connected, required=False)
+    yield
+    warming.cancel()
+    await run_in_threadpool(consumer.stop)
+    await repository.close()
+
+app = FastAPI(title="Order Service v1", version="1.0", lifespan=lifespan)
+instrument(app)
+trace_requests(app, "order-service")
+log_requests(app)
+serve_readiness(app)
+
+
+# only the fields serialize_order reads
+ORDER_PROJECTION = ["userId", "items", "email", "deliveryAddress", "contactUpdatedAt", "status", "createdAt", "updatedAt", "version"]
+
+
+# newest first; _id breaks ties between orders created in the same instant
+ORDERS_SORT = [("createdAt", -1), ("_id", -1)]
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "50"))
+ORDERS_MAX_PAGE_SIZE = int(os.getenv("ORDERS_MAX_PAGE_SIZE", "200"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "500"))
+
+
+def serialize_order(order, contacts=None):
+    """`contacts` comes from resolve_contacts() when the users read model is on."""
+    email, delivery_address = current_contact(order, contacts or {})
     return {
         "orderId": str(order["_id"]),
         "userId": order["userId"],
         "items": order["items"],
-        "email": order["email"],
-        "deliveryAddress": order.get("deliveryAddress", ""),
+        "email": email,
+        "deliveryAddress": delivery_address,
         "status": order["status"],
         "createdAt": order["createdAt"],
-        "updatedAt": order["updatedAt"]
+        "updatedAt": order["updatedAt"],
+        "version": order.get("version", 0)
     }
 
 
-@app.post("/orders")
-def create_order(data: OrderCreate):
-    order = {
+def order_response(order, contacts=None):
+    """serialize_order() with the version as ETag, varied when read-time contact data is shown."""
+    body = serialize_order(order, contacts)
+    variant = None
+    if (body["email"], body["deliveryAddress"]) != (order["email"], order.get("deliveryAddress", "")):
+        variant = zlib.crc32(f'{body["email"]}\n{body["deliveryAddress"]}'.encode("utf-8"))
+    return versioned(body, body["version"], variant)
+
+
+def new_order(data: OrderCreate):
+    return {
         "userId": data.userId,
         "items": [item.dict() for item in data.items],
         "email": data.email,
@@ -32,71 +101,244 @@ def create_order(data: OrderCreate):
         "updatedAt": datetime.utcnow().isoformat()
     }
 
-    result = orders_collection.insert_one(order)
-    order["_id"] = result.inserted_id
-    return serialize_order(order)
 
-# @app.get("/orders")
-# def list_orders(status: str = None):
-#     query = {}
-#     if status:
-#         query["status"] = status
+@app.post("/orders")
+async def create_order(data: OrderCreate, idempotency_key: Optional[str] = Header(None)):
+    async def create():
+        order = new_order(data)
+        result = await repository.orders.insert_one(order)
+        order["_id"] = result.inserted_id
+        return order_response(order)
 
-#     orders = list(orders_collection.find(query))
-#     return [serialize_order(o) for o in orders]
+    # a retried create with the same Idempotency-Key returns the first order instead of placing another
+    return await idempotent(idempotency_key, "order-service POST /orders", data.dict(), create)
 
-@app.put("/orders/{orderId}/status")
-def update_status(orderId: str, data: UpdateStatus):
-    result = orders_collection.find_one_and_update(
-        {"_id": ObjectId(orderId)},
-        {"$set": {"status": data.status, "updatedAt": datetime.utcnow().isoformat()}},
-        return_document=True
-    )
+#lease the oldest unclaimed orders in a status to a fulfillment worker
+@app.post("/orders/claim")
+async def claim_orders(data: ClaimOrders):
+    check_status(data.status)
+    limit = max(1, min(data.limit, CLAIM_MAX_SIZE))
+    lease_seconds = max(1.0, min(data.leaseSeconds or CLAIM_LEASE_SECONDS, CLAIM_MAX_LEASE_SECONDS))
 
-    if not result:
-        raise HTTPException(404, "Order not found")
+    token, expires_at, orders = await claim(data.status, limit, data.worker, lease_seconds, ORDER_PROJECTION)
+    contacts = await resolve_contacts(orders)
+    return {
+        "leaseToken": token,
+        "leaseExpiresAt": expires_at,
+        "orders": [serialize_order(o, contacts) for o in orders]
+    }
 
-    return serialize_order(result)
+#hand claimed orders back before their lease runs out (e.g. on worker shutdown)
+@app.post("/orders/release")
+async def release_orders(data: ReleaseOrders):
+    return {"released": await release(data.leaseToken)}
 
-@app.put("/orders/{orderId}/email")
-def update_email(orderId: str, data: UpdateEmail):
-    result = orders_collection.find_one_and_update(
-        {"_id": ObjectId(orderId)},
-        {"$set": {"email": data.email, "updatedAt": datetime.utcnow().isoformat()}},
-        return_document=True
+def check_batch_size(size):
+    if size > BATCH_MAX_SIZE:
+        raise HTTPException(413, f"Batch too large, max {BATCH_MAX_SIZE} items")
+
+#create many orders with one insert_many; failures are reported per item
+@app.post("/orders/batch")
+async def create_orders(data: List[OrderCreate]):
+    check_batch_size(len(data))
+    orders = [new_order(d) for d in data]
+
+    failed = {}
+    if orders:
+        try:
+            await repository.orders.insert_many(orders, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: err["errmsg"] for err in e.details["writeErrors"]}
+
+    return {
+        "created": [serialize_order(o) for i, o in enumerate(orders) if i not in failed],
+        "errors": [{"index": i, "error": msg} for i, msg in sorted(failed.items())]
+    }
+
+#get many orders by id with one $in query (?ids=a,b,c)
+async def get_orders_by_ids(ids: str):
+    raw = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    check_batch_size(len(raw))
+    object_ids = []
+    for i in raw:
+        try:
+            object_ids.append(ObjectId(i))
+        except InvalidId:
+            pass
+
+    found = await repository.orders.find_many({"_id": {"$in": object_ids}}, ORDER_PROJECTION)
+    contacts = await resolve_contacts(found)
+    by_id = {str(o["_id"]): serialize_order(o, contacts) for o in found}
+    return {
+        "orders": [by_id[i] for i in raw if i in by_id],
+        "missing": [i for i in raw if i not in by_id]
+    }
+
+#keyset pagination: the cursor is the (createdAt, _id) of the last order on a page
+def encode_cursor(order):
+    raw = json.dumps([order["createdAt"], str(order["_id"])]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return created_at, ObjectId(order_id)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(400, "Invalid cursor")
+
+def orders_query(status=None, userId=None, cursor=None):
+    query = {}
+    if status:
+        query["status"] = status
+    if userId:
+        query["userId"] = userId
+    if cursor:
+        created_at, order_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"createdAt": {"$lt": created_at}},
+            {"createdAt": created_at, "_id": {"$lt": order_id}}
+        ]
+    return query
+
+@app.get("/orders")
+async def list_orders(status: Optional[str] = None, userId: Optional[str] = None,
+                      limit: int = ORDERS_PAGE_SIZE, cursor: Optional[str] = None,
+                      ids: Optional[str] = None):
+    if ids is not None:
+        return await get_orders_by_ids(ids)
+
+    limit = max(1, min(limit, ORDERS_MAX_PAGE_SIZE))
+
+    # one extra document tells us whether there is a next page
+    orders = await repository.orders.find_many(
+        orders_query(status, userId, cursor), ORDER_PROJECTION, sort=ORDERS_SORT, limit=limit + 1
     )
+    page = orders[:limit]
+    contacts = await resolve_contacts(page)
+    return {
+        "orders": [serialize_order(o, contacts) for o in page],
+        "nextCursor": encode_cursor(page[-1]) if len(orders) > limit else None
+    }
 
-    if not result:
-        raise HTTPException(404, "Order not found")
+#NDJSON export: streamed from the cursor one batch at a time, never held in memory as a list
+@app.get("/orders/export")
+async def export_orders(status: Optional[str] = None, userId: Optional[str] = None):
+    async def lines():
+        batches = repository.orders.stream_batches(orders_query(status, userId), ORDER_PROJECTION, sort=ORDERS_SORT)
+        async for batch in batches:
+            # one snapshot lookup per batch rather than per order
+            contacts = await resolve_contacts(batch)
+            yield "".join(json.dumps(serialize_order(order, contacts)) + "\n" for order in batch)
 
-    return serialize_order(result)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-@app.put("/orders/{orderId}/address")
-def update_address(orderId: str, data: UpdateAddress):
-    result = orders_collection.find_one_and_update(
-        {"_id": ObjectId(orderId)},
-        {"$set": {"deliveryAddress": data.deliveryAddress, "updatedAt": datetime.utcnow().isoformat()}},
+async def update_order(orderId, fields, if_match, conditions=None, unset=(), conflict=None):
+    """
+    Set `fields` on the order and bump its version. Nothing is written when
+    every field already has the requested value; with If-Match, nothing is
+    written unless the order is still at that version (412). Extra filter
+    `conditions` that fail are a 409 with the detail `conflict(order)` gives.
+    """
+    expected = parse_if_match(if_match)
+    condition = {"_id": ObjectId(orderId), "$or": [{name: {"$ne": value}} for name, value in fields.items()]}
+    if expected is not None:
+        condition.update(version_filter(expected))
+    condition.update(conditions or {})
+
+    now = datetime.utcnow().isoformat()
+    changes = {**fields, "updatedAt": now}
+    if "email" in fields or "deliveryAddress" in fields:
+        changes["contactUpdatedAt"] = now
+
+    update = {"$set": changes, "$inc": {"version": 1}}
+    if unset:
+        update["$unset"] = {field: "" for field in unset}
+
+    result = await repository.orders.find_one_and_update(
+        condition,
+        update,
+        projection=ORDER_PROJECTION,
         return_document=True
     )
-
     if not result:
-        raise HTTPException(404, "Order not found!")
+        # Missing, at another version, failing `conditions`, or already as requested
+        result = await repository.orders.find_one({"_id": ObjectId(orderId)}, ORDER_PROJECTION + LEASE_FIELDS)
+        if not result:
+            raise HTTPException(404, "Order not found")
+        if expected is not None and result.get("version", 0) != expected:
+            raise VersionConflict(result.get("version", 0))
+        if conditions and any(result.get(name) != value for name, value in fields.items()):
+            raise HTTPException(409, conflict(result))
+
+    return order_response(result, await resolve_contacts([result]))
 
-    return serialize_order(result)
+def check_status(status):
+    if status not in STATUS_TRANSITIONS:
+        raise HTTPException(422, f"Unknown status {status}, expected one of {', '.join(STATUS_TRANSITIONS)}")
+
+#only transitions in STATUS_TRANSITIONS are applied, checked atomically in the update filter
+@app.put("/orders/{orderId}/status")
+async def update_status(orderId: str, data: UpdateStatus, if_match: Optional[str] = Header(None),
+                        idempotency_key: Optional[str] = Header(None)):
+    check_status(data.status)
+    conditions = {"status": {"$in": sources(data.status)}}
+    if data.leaseToken:
+        conditions["leaseToken"] = data.leaseToken
+
+    def conflict(order):
+        if data.leaseToken and order.get("leaseToken") != data.leaseToken:
+            return "Lease on this order expired or was claimed by another worker"
+        return f"Order is {order['status']}, it cannot move to {data.status}"
+
+    async def update():
+        fields = {"status": data.status}
+        if USER_READ_MODEL and data.status in FROZEN_STATUSES:
+            # Frozen orders stop following the users snapshot: store the contact
+            # it resolves to now, which is the one the order ships with
+            order = await repository.orders.find_one({"_id": ObjectId(orderId)}, ORDER_PROJECTION)
+            if order:
+                email, delivery_address = current_contact(order, await resolve_contacts([order]))
+                fields.update(email=email, deliveryAddress=delivery_address)
+        # leaving a status also ends any claim on the order
+        return await update_order(orderId, fields, if_match, conditions, LEASE_FIELDS, conflict)
+
+    return await idempotent(idempotency_key, f"order-service PUT /orders/{orderId}/status", data.dict(), update)
+
+@app.put("/orders/{orderId}/email")
+async def update_email(orderId: str, data: UpdateEmail, if_match: Optional[str] = Header(None),
+                       idempotency_key: Optional[str] = Header(None)):
+    return await idempotent(idempotency_key, f"order-service PUT /orders/{orderId}/email", data.dict(),
+                            lambda: update_order(orderId, {"email": data.email}, if_match))
+
+@app.put("/orders/{orderId}/address")
+async def update_address(orderId: str, data: UpdateAddress, if_match: Optional[str] = Header(None),
+                         idempotency_key: Optional[str] = Header(None)):
+    return await idempotent(idempotency_key, f"order-service PUT /orders/{orderId}/address", data.dict(),
+                            lambda: update_order(orderId, {"deliveryAddress": data.deliveryAddress}, if_match))
 
 @app.get("/orders/{orderId}")
-def get_order(orderId: str):
-    order = orders_collection.find_one({"_id": ObjectId(orderId)})
+async def get_order(orderId: str):
+    order = await repository.orders.find_one({"_id": ObjectId(orderId)}, ORDER_PROJECTION)
     if not order:
         raise HTTPException(404, "Order not found!")
-    return serialize_order(order)
+    return order_response(order, await resolve_contacts([order]))
+
+# explain every query shape this service runs and flag collection scans
+@app.get("/admin/query-plans")
+async def query_plans():
+    return await run_in_threadpool(check_query_plans)
+
+# user-updates consumer throughput and lag
+@app.get("/metrics/consumer")
+async def consumer_metrics():
+    return consumer_stats.snapshot()
+
+# users read model LRU (USER_READ_MODEL=true)
+@app.get("/metrics/user-snapshots")
+async def user_snapshot_metrics():
+    return snapshot_cache.stats()
 
 # Health check
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok", "service": "order-service"}
-
-import threading
-from .consumer import start_consumer
-
-threading.Thread(target=start_consumer, daemon=True).start()
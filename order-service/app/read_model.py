@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from pymongo import UpdateOne
+from . import repository
+from .metrics import registry
+
+# -----------------------------
+# Users read model (opt-in)
+# -----------------------------
+# Orders embed the email and delivery address they were placed with. By
+# default the consumer keeps those current by rewriting every order of a user
+# on each UserUpdated event, which costs O(orders) writes per event. With
+# USER_READ_MODEL=true it instead upserts one document per user into
+# users_snapshot, and serialize_order resolves current contact data from that
+# snapshot at read time (through an in-process LRU). When an order moves into
+# a FROZEN_STATUSES state, update_status stores the contact it resolves to at
+# that moment and the snapshot is ignored from then on. A contact change made
+# on the order itself wins over an older snapshot.
+#
+# The user-updates queue is shared by all replicas, so only the replica that
+# consumed an event refreshes its LRU; entries expire after
+# USER_SNAPSHOT_CACHE_TTL seconds to bound how stale the others can be.
+
+USER_READ_MODEL = os.getenv("USER_READ_MODEL", "false").lower() == "true"
+USER_SNAPSHOT_CACHE_SIZE = int(os.getenv("USER_SNAPSHOT_CACHE_SIZE", "10000"))
+USER_SNAPSHOT_CACHE_TTL = float(os.getenv("USER_SNAPSHOT_CACHE_TTL", "5"))
+
+FROZEN_STATUSES = {s.strip() for s in os.getenv("FROZEN_STATUSES", "SHIPPED,DELIVERED").split(",") if s.strip()}
+
+# only the fields resolve_contacts reads
+SNAPSHOT_PROJECTION = ["email", "deliveryAddress", "updatedAt"]
+
+
+class SnapshotCache:
+    """Thread-safe LRU of userId -> snapshot (None = no snapshot), with a TTL."""
+
+    def __init__(self, size=USER_SNAPSHOT_CACHE_SIZE, ttl=USER_SNAPSHOT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """(found, snapshot); found is False when the user must be looked up."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, user_id, snapshot):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, snapshot)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = SnapshotCache()
+
+registry.callback("user_snapshot_cache_hits_total", "User snapshot lookups served from the in-process LRU",
+                  "counter", lambda: cache.hits)
+registry.callback("user_snapshot_cache_misses_total", "User snapshot lookups that went to MongoDB",
+                  "counter", lambda: cache.misses)
+
+
+def snapshot_fields(event, consumed_at):
+    """Events without a timestamp count as changed when they were consumed."""
+    return {
+        "email": event["data"]["email"],
+        "deliveryAddress": event["data"]["deliveryAddress"],
+        "updatedAt": event.get("timestamp") or consumed_at
+    }
+
+
+def snapshot_writes(events, consumed_at):
+    """
+    The consumer's bulk_write for {userId: newest event}: an upsert per user,
+    guarded by the event's sequence so an older event never overwrites a newer
+    snapshot.
+    """
+    operations = []
+    for user_id, event in events.items():
+        fields = snapshot_fields(event, consumed_at)
+        sequence = event.get("sequence")
+        if sequence is None:
+            operations.append(UpdateOne({"_id": user_id}, {"$set": fields}, upsert=True))
+            continue
+        fields["sequence"] = sequence
+        # Updates an older snapshot or creates a missing one; a newer snapshot matches neither
+        operations.append(UpdateOne({"_id": user_id, "sequence": {"$not": {"$gte": sequence}}}, {"$set": fields}))
+        operations.append(UpdateOne({"_id": user_id}, {"$setOnInsert": fields}, upsert=True))
+    return operations
+
+
+def refresh(events, consumed_at):
+    """Called by the consumer once its snapshot writes succeeded."""
+    for user_id, event in events.items():
+        cache.put(user_id, snapshot_fields(event, consumed_at))
+
+
+async def resolve_contacts(orders):
+    """
+    {userId: snapshot} for the users of every non-frozen order in `orders`,
+    from the LRU where possible and one $in query for the rest.
+    """
+    if not USER_READ_MODEL:
+        return {}
+
+    contacts = {}
+    missing = []
+    for user_id in {o["userId"] for o in orders if o.get("status") not in FROZEN_STATUSES}:
+        found, snapshot = cache.get(user_id)
+        if not found:
+            missing.append(user_id)
+        elif snapshot is not None:
+            contacts[user_id] = snapshot
+
+    if missing:
+        found = {s["_id"]: s for s in await repository.users_snapshot.find_many(
+            {"_id": {"$in": missing}}, SNAPSHOT_PROJECTION
+        )}
+        for user_id in missing:
+            snapshot = found.get(user_id)
+            cache.put(user_id, snapshot)
+            if snapshot is not None:
+                contacts[user_id] = snapshot
+    return contacts
+
+
+def current_contact(order, contacts):
+    """The email and deliveryAddress to show for `order`."""
+    snapshot = contacts.get(order["userId"])
+    # Orders written before contactUpdatedAt existed were last changed at creation
+    own = order.get("contactUpdatedAt") or order.get("createdAt") or ""
+    if snapshot is not None and order.get("status") not in FROZEN_STATUSES and (snapshot.get("updatedAt") or "") > own:
+        return snapshot["email"], snapshot.get("deliveryAddress", "")
+    return order["email"], order.get("deliveryAddress", "")
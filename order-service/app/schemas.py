@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 class OrderItem(BaseModel):
     productId: str
@@ -13,6 +13,17 @@ class OrderCreate(BaseModel):
 
 class UpdateStatus(BaseModel):
     status: str
+    # from POST /orders/claim; the update only applies while that lease is held
+    leaseToken: Optional[str] = None
+
+class ClaimOrders(BaseModel):
+    worker: str
+    status: str = "PENDING"
+    limit: int = 10
+    leaseSeconds: Optional[float] = None
+
+class ReleaseOrders(BaseModel):
+    leaseToken: str
 
 class UpdateEmail(BaseModel):
     email: str
@@ -0,0 +1,95 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# user-events envelope
+# -----------------------------
+# Versioned UserUpdated events; the AMQP content_type names the codec, v1 events are converted on read.
+
+EVENT_VERSION = 2
+EVENT_CODEC = os.getenv("EVENT_CODEC", "json").lower()
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, event):
+        return json.dumps(event, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, event):
+        return msgpack.packb(event, use_bin_type=True)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+# content_type -> codec, for the codecs this process can read
+CODECS = {JsonCodec.content_type: JsonCodec()}
+if msgpack is not None:
+    CODECS[MsgpackCodec.content_type] = MsgpackCodec()
+
+codec = next((c for c in CODECS.values() if c.name == EVENT_CODEC), None)
+if codec is None:
+    logger.warning(f"EVENT_CODEC={EVENT_CODEC} is not available, publishing events as JSON")
+    codec = CODECS[JsonCodec.content_type]
+
+
+def format_address(address):
+    """The flat delivery address string for V1's string or V2's {street, city, postal}."""
+    if isinstance(address, dict):
+        return f"{address.get('street', '')}, {address.get('city', '')}, {address.get('postal', '')}"
+    return address
+
+
+def user_updated(user_id, sequence, timestamp, email, address):
+    """A UserUpdated envelope; `address` is V1's string or V2's {street, city, postal}."""
+    data = {"email": email, "deliveryAddress": format_address(address)}
+    if isinstance(address, dict):
+        data["address"] = address
+    return {
+        "type": "UserUpdated",
+        "version": EVENT_VERSION,
+        "userId": user_id,
+        "sequence": sequence,
+        "timestamp": timestamp,
+        "data": data
+    }
+
+
+def encode(event):
+    """(content_type, body) for publishing `event` with the configured codec."""
+    return codec.content_type, codec.encode(event)
+
+
+def decode(body, content_type=None):
+    """The envelope in a message body; raises ValueError if it cannot be read."""
+    reader = CODECS.get(content_type or JsonCodec.content_type)
+    if reader is None:
+        raise ValueError(f"unsupported content type {content_type}")
+
+    event = reader.decode(body)
+    if not isinstance(event, dict):
+        raise ValueError("event is not an object")
+    if "version" not in event:
+        event = user_updated(event.get("userId"), None, event.get("updatedAt"), event.get("email"),
+                             event.get("address") or event.get("deliveryAddress"))
+    if not event.get("userId") or not isinstance(event.get("data"), dict) or "email" not in event["data"]:
+        raise ValueError("event has no userId/email")
+    return event
@@ -1,11 +1,58 @@
-from fastapi import HTTPException, FastAPI
-from .database import users_collection
+from fastapi import HTTPException, FastAPI, Header
 from .schemas import UserCreate, UpdateAddress, UpdateEmail
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
 from datetime import datetime
-from .publisher import publish_user_updated
+from typing import List, Optional
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from .publisher import publisher
+from .outbox import update_user_with_event, relay
+from . import repository
+from .envelope import user_updated
+from .conditional import idempotent, parse_if_match, versioned
+from .database import db
+from .indexes import ensure_indexes, check_query_plans, CHECK_QUERY_PLANS
+from .readiness import add_check, warm_up, serve_readiness
+from .metrics import instrument
+from .tracing import trace_requests
+from .logs import setup_logging, log_requests
 
-app = FastAPI (title="User service v1", version = "1.0")
+setup_logging("user-service-v1")
+
+def prepare_database():
+    db.command("ping")
+    ensure_indexes()
+    if CHECK_QUERY_PLANS:
+        check_query_plans()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # MongoDB is warmed up in the background; /ready reports when it is done
+    warming = asyncio.create_task(warm_up("mongo", prepare_database))
+    # Open the broker connection up front so the first PUT doesn't pay for it
+    publisher.start()
+    relay.start()
+    add_check("rabbitmq", lambda: publisher.ready, required=False)
+    yield
+    warming.cancel()
+    relay.stop()
+    publisher.stop()
+    await repository.close()
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "500"))
+
+app = FastAPI (title="User service v1", version = "1.0", lifespan=lifespan)
+instrument(app)
+trace_requests(app, "user-service-v1")
+log_requests(app)
+serve_readiness(app)
+
+#only the fields serialize_user reads:
+USER_PROJECTION = ["email", "deliveryAddress", "createdAt", "updatedAt", "version"]
 
 #serializer:
 def serialize_user(user):
@@ -14,74 +61,121 @@ def serialize_user(user):
         "email" : user["email"],
         "deliveryAddress" : user["deliveryAddress"],
         "createdAt" : user["createdAt"],
-        "updatedAt" : user["updatedAt"]
+        "updatedAt" : user["updatedAt"],
+        "version" : user.get("version", 0)
     }
 
-#create users:
-@app.post("/users")
-def create_user(data: UserCreate):
-    user = {
+#event sent to order-service whenever email/address changes:
+def user_updated_event(user):
+    return user_updated(str(user["_id"]), user["version"], user.get("updatedAt"), user["email"], user["deliveryAddress"])
+
+def new_user(data: UserCreate):
+    return {
         "email":data.email,
         "deliveryAddress":data.deliveryAddress,
         "createdAt": datetime.utcnow().isoformat(),
         "updatedAt": datetime.utcnow().isoformat()
     }
 
-    result = users_collection.insert_one(user)
-    user["_id"] = result.inserted_id
-    return serialize_user(user)
+#create users:
+@app.post("/users")
+async def create_user(data: UserCreate, idempotency_key: Optional[str] = Header(None)):
+    async def create():
+        user = new_user(data)
+        result = await repository.users.insert_one(user)
+        user["_id"] = result.inserted_id
+        return versioned(serialize_user(user), 0)
 
-#now let's updte email:
-@app.put("/users/{userId}/email")
-def update_email(userId: str, data: UpdateEmail):
-    result = users_collection.find_one_and_update(
-        {"_id": ObjectId(userId)},
-        {"$set": {"email": data.email, "updatedAt": datetime.utcnow().isoformat()}},
-        return_document= True
-    )
-    if not result:
-        raise HTTPException(status_code=404, detail="User Not Found!")
-    event = {
-        "type": "UserUpdated",
-        "userId": str(result["_id"]),
-        "email": data.email,
-        "deliveryAddress": result["deliveryAddress"]
+    # a retried create with the same Idempotency-Key returns the first user instead of adding another
+    return await idempotent(idempotency_key, "user-service-v1 POST /users", data.dict(), create)
+
+def check_batch_size(size):
+    if size > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large, max {BATCH_MAX_SIZE} items")
+
+def parse_ids(ids: str):
+    """Split a comma-separated id list; returns (unique ids, the ones that are valid ObjectIds)."""
+    raw = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    check_batch_size(len(raw))
+    object_ids = []
+    for i in raw:
+        try:
+            object_ids.append(ObjectId(i))
+        except InvalidId:
+            pass
+    return raw, object_ids
+
+#create many users with one insert_many; failures are reported per item:
+@app.post("/users/batch")
+async def create_users(data: List[UserCreate]):
+    check_batch_size(len(data))
+    users = [new_user(d) for d in data]
+
+    failed = {}
+    if users:
+        try:
+            await repository.users.insert_many(users, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: err["errmsg"] for err in e.details["writeErrors"]}
+
+    return {
+        "created": [serialize_user(u) for i, u in enumerate(users) if i not in failed],
+        "errors": [{"index": i, "error": msg} for i, msg in sorted(failed.items())]
     }
 
-    publish_user_updated(event)
+#get many users by id with one $in query (?ids=a,b,c):
+@app.get("/users")
+async def get_users(ids: str):
+    raw, object_ids = parse_ids(ids)
+    found = await repository.users.find_many({"_id": {"$in": object_ids}}, USER_PROJECTION)
+    by_id = {str(u["_id"]): serialize_user(u) for u in found}
+    return {
+        "users": [by_id[i] for i in raw if i in by_id],
+        "missing": [i for i in raw if i not in by_id]
+    }
 
-    return serialize_user(result)
+#now let's updte email:
+@app.put("/users/{userId}/email")
+async def update_email(userId: str, data: UpdateEmail, if_match: Optional[str] = Header(None),
+                       idempotency_key: Optional[str] = Header(None)):
+    return await idempotent(idempotency_key, f"user-service-v1 PUT /users/{userId}/email", data.dict(),
+                            lambda: update_user(userId, {"email": data.email}, if_match))
 
-#now I will update address for user:
-@app.put("/users/{userId}/address")
-def update_address(userId:str, data:UpdateAddress):
-    result = users_collection.find_one_and_update(
-        {"_id": ObjectId(userId)},
-        {"$set": {"deliveryAddress": data.deliveryAddress, "updatedAt": datetime.utcnow().isoformat()}},
-        return_document= True
+async def update_user(userId, fields, if_match):
+    # the user update and its UserUpdated event are written together
+    result = await update_user_with_event(
+        ObjectId(userId),
+        fields,
+        user_updated_event,
+        USER_PROJECTION,
+        parse_if_match(if_match)
     )
     if not result:
         raise HTTPException(status_code=404, detail="User Not Found!")
-    event = {
-        "type": "UserUpdated",
-        "userId": str(result["_id"]),
-        "email": result["email"],
-        "deliveryAddress": data.deliveryAddress
-    }
 
-    publish_user_updated(event)
+    return versioned(serialize_user(result), result.get("version", 0))
 
-    return serialize_user(result)
+#now I will update address for user:
+@app.put("/users/{userId}/address")
+async def update_address(userId:str, data:UpdateAddress, if_match: Optional[str] = Header(None),
+                         idempotency_key: Optional[str] = Header(None)):
+    return await idempotent(idempotency_key, f"user-service-v1 PUT /users/{userId}/address", data.dict(),
+                            lambda: update_user(userId, {"deliveryAddress": data.deliveryAddress}, if_match))
 
 #get user by ID:
 @app.get("/users/{userId}")
-def get_user(userId:str):
-    user = users_collection.find_one({"_id": ObjectId(userId)})
+async def get_user(userId:str):
+    user = await repository.users.find_one({"_id": ObjectId(userId)}, USER_PROJECTION)
     if not user:
         raise HTTPException(status_code=404, detail="User Not Found!")
-    return serialize_user(user)
+    return versioned(serialize_user(user), user.get("version", 0))
+
+# explain every query shape this service runs and flag collection scans
+@app.get("/admin/query-plans")
+async def query_plans():
+    return await run_in_threadpool(check_query_plans)
 
 # Health check
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok", "service": "user-service-v1"}
\ No newline at end of file
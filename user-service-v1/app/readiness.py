@@ -0,0 +1,69 @@
+import os
+import asyncio
+import logging
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# Readiness
+# -----------------------------
+# GET /ready: 200 once every required check passes, else 503. /health only says the process is up.
+
+WARM_UP_RETRY_MIN = float(os.getenv("WARM_UP_RETRY_MIN", "0.5"))
+WARM_UP_RETRY_MAX = float(os.getenv("WARM_UP_RETRY_MAX", "15"))
+
+# name -> (check, required); a check is a cheap callable returning a bool
+checks = {}
+
+warmed = set()
+
+
+def add_check(name, check, required=True):
+    checks[name] = (check, required)
+
+
+def status():
+    """(ready, {name: {"ok", "required"}})"""
+    results = {}
+    ready = True
+    for name, (check, required) in checks.items():
+        try:
+            ok = bool(check())
+        except Exception:
+            ok = False
+        results[name] = {"ok": ok, "required": required}
+        if required and not ok:
+            ready = False
+    return ready, results
+
+
+async def warm_up(name, prepare, required=True):
+    """
+    Run the blocking `prepare` in the threadpool until it succeeds, backing
+    off between attempts; the `name` check passes from then on. Meant for
+    asyncio.create_task in a lifespan (cancel it on shutdown).
+    """
+    add_check(name, lambda: name in warmed, required)
+    delay = WARM_UP_RETRY_MIN
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await run_in_threadpool(prepare)
+        except Exception as e:
+            logger.warning(f"{name} not ready (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARM_UP_RETRY_MAX)
+            continue
+        warmed.add(name)
+        logger.info(f"{name} ready after {attempt} attempt(s)")
+        return
+
+
+def serve_readiness(app):
+    @app.get("/ready", include_in_schema=False)
+    async def ready():
+        is_ready, results = status()
+        return JSONResponse({"ready": is_ready, "checks": results}, status_code=200 if is_ready else 503)
@@ -0,0 +1,84 @@
+import logging
+import os
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+from .database import db
+from .conditional import IDEMPOTENCY_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CHECK_QUERY_PLANS = os.getenv("CHECK_QUERY_PLANS", "false").lower() == "true"
+
+# -----------------------------
+# Declarative index spec
+# -----------------------------
+# collection -> indexes it must have. ensure_indexes() creates any that are
+# missing at startup (create_indexes is a no-op for ones that already exist).
+
+INDEXES = {
+    "users_db": [
+        # lookups by email; V1 and V2 share this collection
+        IndexModel([("email", ASCENDING)], name="email_1")
+    ],
+    "users_outbox": [
+        # outbox relay: oldest PENDING / expired IN_FLIGHT events first
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_1__id_1")
+    ],
+    "idempotency_keys": [
+        # Idempotency-Key records expire once clients can no longer be retrying
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_1", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    ]
+}
+
+# Representative shapes of every query this service runs, checked with explain
+QUERY_SHAPES = [
+    {"name": "get user by id", "collection": "users_db", "filter": {"_id": ObjectId()}},
+    {"name": "user by email", "collection": "users_db", "filter": {"email": ""}},
+    {"name": "outbox events to relay", "collection": "users_outbox",
+     "filter": {"status": "PENDING"}, "sort": {"_id": 1}}
+]
+
+
+def ensure_indexes():
+    created = {}
+    for collection, indexes in INDEXES.items():
+        try:
+            created[collection] = db[collection].create_indexes(indexes)
+        except PyMongoError as e:
+            logger.error(f"Could not create indexes on {collection}: {e}")
+            created[collection] = []
+    return created
+
+
+def plan_stages(plan):
+    """Yield every stage name in an explain plan tree."""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        yield from plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+def check_query_plans():
+    """Explain each query shape and report which ones would scan the whole collection."""
+    report = []
+    for shape in QUERY_SHAPES:
+        command = {"find": shape["collection"], "filter": shape["filter"]}
+        if "sort" in shape:
+            command["sort"] = shape["sort"]
+        try:
+            explained = db.command("explain", command, verbosity="queryPlanner")
+        except PyMongoError as e:
+            report.append({"query": shape["name"], "error": str(e)})
+            continue
+
+        stages = list(plan_stages(explained.get("queryPlanner", {}).get("winningPlan")))
+        collscan = "COLLSCAN" in stages
+        if collscan:
+            logger.warning(f"Query '{shape['name']}' does a COLLSCAN on {shape['collection']}")
+        report.append({"query": shape["name"], "stages": stages, "collscan": collscan})
+    return report
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime, timezone
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import Request
+from .tracing import current_context
+from .metrics import registry
+
+# -----------------------------
+# Structured logging
+# -----------------------------
+# JSON lines written to stdout by a listener thread behind a bounded queue.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# httpx logs every request at INFO, and pika logs each failed connection attempt
+# as several ERRORs that our own reconnect warnings already cover; LOG_LEVELS overrides
+QUIET_LOGGERS = {"httpx": "WARNING", "httpcore": "WARNING", "pika": "CRITICAL"}
+
+request_id = ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id", "trace_id"}
+
+
+class ContextFilter(logging.Filter):
+    """Stamp the caller's request and trace ids on the record before it changes threads."""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        context = current_context.get()
+        record.trace_id = context.trace_id if context is not None else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a sample of DEBUG records; everything above passes."""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < LOG_DEBUG_SAMPLE_RATE
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; only resolve the message here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+handler = None
+
+
+def setup_logging(service):
+    """Route all logging (ours and uvicorn's) through the JSON queue handler."""
+    global handler
+    if handler is not None:
+        return
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter())
+
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setFormatter(JsonFormatter(service))
+    listener = QueueListener(log_queue, stdout)
+    listener.start()
+    atexit.register(listener.stop)
+
+    registry.callback("log_records_dropped_total", "Log records dropped because the log queue was full",
+                      "counter", lambda: handler.dropped)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    for name, level in QUIET_LOGGERS.items():
+        logging.getLogger(name).setLevel(level)
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def with_request_id(headers=None):
+    """Copy of `headers` carrying the current request id, if there is one."""
+    headers = dict(headers or {})
+    current = request_id.get()
+    if current:
+        headers[REQUEST_ID_HEADER] = current
+    return headers
+
+
+def log_requests(app):
+    """Give every request an id (the caller's X-Request-ID, or a new one) and echo it back."""
+
+    @app.middleware("http")
+    async def assign_request_id(request: Request, call_next):
+        token = request_id.set(request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex)
+        try:
+            response = await call_next(request)
+            response.headers[REQUEST_ID_HEADER] = request_id.get()
+            return response
+        finally:
+            request_id.reset(token)
@@ -0,0 +1,255 @@
+import logging
+import os
+import uuid
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.errors import PyMongoError, OperationFailure, ConfigurationError
+from .database import outbox_collection
+from .publisher import publisher
+from . import repository
+from .metrics import registry
+from .tracing import current_traceparent
+from .conditional import VersionConflict, version_filter
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_USE_TRANSACTIONS = os.getenv("OUTBOX_USE_TRANSACTIONS", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv("OUTBOX_MAX_IN_FLIGHT", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.5"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "30"))
+
+# Standalone mongod (e.g. the local docker-compose one) has no transactions;
+# flipped to False on the first write that proves it.
+transactions_supported = OUTBOX_USE_TRANSACTIONS
+
+
+# -----------------------------
+# Transactional outbox writes
+# -----------------------------
+
+async def update_user_with_event(user_id, fields, build_event, projection=None, expected_version=None):
+    """
+    Set `fields` on the user and record the UserUpdated event built from the
+    updated document in the outbox, in one Mongo transaction. Returns the user
+    (limited to `projection`), or None when it does not exist.
+
+    The write bumps the user's version, which `build_event` uses as the event
+    sequence. When every field already has the requested value nothing is
+    written and no event is recorded. With `expected_version`, the write only
+    happens while the user is at that version; otherwise VersionConflict.
+    """
+    global transactions_supported
+
+    if projection is not None:
+        projection = list(projection) + ["version"]
+    # Only matches when something would change (and at the expected version)
+    condition = {"_id": user_id, "$or": [{name: {"$ne": value}} for name, value in fields.items()]}
+    if expected_version is not None:
+        condition.update(version_filter(expected_version))
+    update = {"$set": {**fields, "updatedAt": datetime.utcnow().isoformat()}, "$inc": {"version": 1}}
+
+    async def write(session=None):
+        result = await repository.users.find_one_and_update(
+            condition,
+            update,
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if result:
+            event = build_event(result)
+            await repository.outbox.insert_one({
+                "userId": event["userId"],
+                "event": event,
+                # the relay publishes on another thread; carry the request's trace over
+                "traceparent": current_traceparent(),
+                "status": "PENDING",
+                "attempts": 0,
+                "createdAt": datetime.utcnow()
+            }, session=session)
+        return result
+
+    result = None
+    written = False
+    if transactions_supported:
+        try:
+            result = await repository.transaction(write)
+            written = True
+        except (OperationFailure, ConfigurationError) as e:
+            # IllegalOperation (20): not a replica set member or mongos
+            if getattr(e, "code", None) not in (20, None):
+                raise
+            logger.warning(f"MongoDB transactions unavailable, writing outbox without them: {e}")
+            transactions_supported = False
+
+    if not written:
+        result = await write()
+    if result:
+        relay.notify()
+        return result
+
+    # Missing, at another version, or already as requested
+    current = await repository.users.find_one({"_id": user_id}, projection)
+    if current is not None and expected_version is not None and current.get("version", 0) != expected_version:
+        raise VersionConflict(current.get("version", 0))
+    return current
+
+
+# -----------------------------
+# Outbox relay
+# -----------------------------
+
+class OutboxRelay:
+    """
+    Background thread that drains the outbox to the user-events exchange.
+
+    Events are claimed in _id (i.e. write) order under a lease and handed to
+    the publisher, which keeps them in order on one channel and retries until
+    the broker confirms; confirmed events are then deleted from the outbox.
+    Users with an event leased by another relay are skipped, so events for one
+    userId are never published out of order across service replicas. Leases
+    left behind by a crashed relay expire and are picked up again.
+    """
+
+    def __init__(self):
+        self.relay_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.confirmed = deque()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.relayed = 0
+        self.delivered = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "relayed": self.relayed,
+            "delivered": self.delivered,
+            "transactions": transactions_supported
+        }
+
+    def _run(self):
+        while not self.stopped.is_set():
+            claimed = 0
+            try:
+                self._delete_confirmed()
+                self._renew_leases()
+                claimed = self._relay_batch()
+            except PyMongoError as e:
+                logger.error(f"Outbox relay error: {e}")
+
+            if not claimed:
+                self.wakeup.wait(OUTBOX_POLL_INTERVAL)
+                self.wakeup.clear()
+
+        try:
+            self._delete_confirmed()
+        except PyMongoError:
+            pass
+
+    def _on_confirm(self, outbox_id):
+        # Runs on the publisher thread; deletion happens in batches on ours
+        self.confirmed.append(outbox_id)
+
+    def _delete_confirmed(self):
+        ids = []
+        while self.confirmed:
+            ids.append(self.confirmed.popleft())
+        if not ids:
+            return
+        outbox_collection.delete_many({"_id": {"$in": ids}})
+        with self.lock:
+            self.in_flight.difference_update(ids)
+        self.delivered += len(ids)
+
+    def _renew_leases(self):
+        with self.lock:
+            ids = list(self.in_flight)
+        if ids:
+            outbox_collection.update_many(
+                {"_id": {"$in": ids}, "leasedBy": self.relay_id},
+                {"$set": {"leaseUntil": datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS)}}
+            )
+
+    def _relay_batch(self):
+        with self.lock:
+            room = min(OUTBOX_BATCH_SIZE, OUTBOX_MAX_IN_FLIGHT - len(self.in_flight))
+            own = list(self.in_flight)
+        if room <= 0:
+            return 0
+
+        now = datetime.utcnow()
+        claimable = {"$or": [
+            {"status": "PENDING"},
+            {"status": "IN_FLIGHT", "leaseUntil": {"$lte": now}}
+        ]}
+        blocked = set(outbox_collection.distinct("userId", {
+            "status": "IN_FLIGHT",
+            "leaseUntil": {"$gt": now},
+            "leasedBy": {"$ne": self.relay_id}
+        }))
+        candidates = outbox_collection.find(
+            {**claimable, "userId": {"$nin": list(blocked)}, "_id": {"$nin": own}},
+            {"userId": 1, "event": 1, "traceparent": 1}
+        ).sort("_id", ASCENDING).limit(room)
+
+        lease_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        claimed = 0
+        for doc in candidates:
+            if doc["userId"] in blocked:
+                continue
+            claim = outbox_collection.update_one(
+                {"_id": doc["_id"], **claimable},
+                {"$set": {"status": "IN_FLIGHT", "leasedBy": self.relay_id, "leaseUntil": lease_until},
+                 "$inc": {"attempts": 1}}
+            )
+            if claim.modified_count == 0:
+                # Another relay got it first; hold back this user's later events
+                blocked.add(doc["userId"])
+                continue
+
+            with self.lock:
+                self.in_flight.add(doc["_id"])
+            outbox_id = doc["_id"]
+            publisher.publish(
+                doc["event"],
+                on_confirm=lambda outbox_id=outbox_id: self._on_confirm(outbox_id),
+                traceparent=doc.get("traceparent")
+            )
+            claimed += 1
+
+        self.relayed += claimed
+        return claimed
+
+
+relay = OutboxRelay()
+
+registry.callback("outbox_relayed_total", "Outbox events handed to the publisher", "counter",
+                  lambda: relay.relayed)
+registry.callback("outbox_delivered_total", "Outbox events confirmed and deleted", "counter",
+                  lambda: relay.delivered)
+registry.callback("outbox_in_flight", "Outbox events leased and awaiting confirmation", "gauge",
+                  lambda: len(relay.in_flight))
@@ -0,0 +1,163 @@
+import logging
+import os
+import itertools
+import threading
+from starlette.concurrency import run_in_threadpool
+from .metrics import mongo_operation_seconds
+from .tracing import span
+from .database import MONGO_URI, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, DB_NAME, db
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# Async data layer
+# -----------------------------
+# Handlers await these repositories instead of calling pymongo directly. With
+# MONGO_ASYNC=true (the default) they run on PyMongo's native AsyncMongoClient,
+# so one worker can keep many Mongo calls in flight; with MONGO_ASYNC=false, or
+# a PyMongo too old to have it, each call runs on the sync client in the
+# threadpool instead. Background threads (consumer, outbox relay) keep using
+# the sync collections from database.py. Both clients are created on first
+# use, not at import.
+
+MONGO_ASYNC = os.getenv("MONGO_ASYNC", "true").lower() == "true"
+STREAM_BATCH_SIZE = int(os.getenv("MONGO_STREAM_BATCH_SIZE", "500"))
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    AsyncMongoClient = None
+
+if MONGO_ASYNC and AsyncMongoClient is None:
+    logger.warning("MONGO_ASYNC requested but this PyMongo has no AsyncMongoClient, using the threadpool")
+
+async_client = None
+_async_client_lock = threading.Lock()
+
+
+def get_async_client():
+    """The shared AsyncMongoClient, or None when calls go through the threadpool."""
+    global async_client
+    if async_client is None and MONGO_ASYNC and AsyncMongoClient is not None:
+        with _async_client_lock:
+            if async_client is None:
+                async_client = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                                minPoolSize=MONGO_MIN_POOL_SIZE)
+    return async_client
+
+
+class Repository:
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def sync(self):
+        return db[self.name]
+
+    @property
+    def aio(self):
+        client = get_async_client()
+        return client[DB_NAME][self.name] if client is not None else None
+
+    async def _call(self, method, *args, **kwargs):
+        with span(f"mongo {method}", collection=self.name), \
+                mongo_operation_seconds.time(collection=self.name, operation=method):
+            if self.aio is not None:
+                return await getattr(self.aio, method)(*args, **kwargs)
+            return await run_in_threadpool(getattr(self.sync, method), *args, **kwargs)
+
+    async def find_one(self, *args, **kwargs):
+        return await self._call("find_one", *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._call("insert_one", *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._call("insert_many", *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._call("find_one_and_update", *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._call("update_one", *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._call("update_many", *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._call("delete_one", *args, **kwargs)
+
+    async def find_many(self, filter, projection=None, sort=None, limit=0):
+        """Run find() and return up to `limit` documents (0 = no limit) as a list."""
+        with span("mongo find", collection=self.name), \
+                mongo_operation_seconds.time(collection=self.name, operation="find"):
+            if self.aio is not None:
+                cursor = self.aio.find(filter, projection, sort=sort, limit=limit)
+                return await cursor.to_list(None)
+            return await run_in_threadpool(
+                lambda: list(self.sync.find(filter, projection, sort=sort, limit=limit))
+            )
+
+    async def stream(self, filter, projection=None, sort=None, batch_size=STREAM_BATCH_SIZE):
+        """Yield find() results one by one, holding at most one cursor batch in memory."""
+        async for batch in self.stream_batches(filter, projection, sort, batch_size):
+            for document in batch:
+                yield document
+
+    async def stream_batches(self, filter, projection=None, sort=None, batch_size=STREAM_BATCH_SIZE):
+        """Yield find() results in lists of up to `batch_size`, for work done once per batch."""
+        if self.aio is not None:
+            batch = []
+            async for document in self.aio.find(filter, projection, sort=sort, batch_size=batch_size):
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
+
+        cursor = self.sync.find(filter, projection, sort=sort, batch_size=batch_size)
+        try:
+            while True:
+                batch = await run_in_threadpool(lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    break
+                yield batch
+        finally:
+            cursor.close()
+
+
+async def transaction(callback):
+    """
+    Run `await callback(session)` inside a Mongo transaction and return its result.
+    Raises OperationFailure/ConfigurationError where transactions are unsupported.
+    """
+    client = get_async_client()
+    if client is not None:
+        async with client.start_session() as session:
+            return await session.with_transaction(callback)
+
+    session = await run_in_threadpool(db.client.start_session)
+    try:
+        session.start_transaction()
+        try:
+            result = await callback(session)
+        except BaseException:
+            await run_in_threadpool(session.abort_transaction)
+            raise
+        await run_in_threadpool(session.commit_transaction)
+        return result
+    finally:
+        session.end_session()
+
+
+async def close():
+    if async_client is not None:
+        await async_client.close()
+
+
+# This service's collections (the rest of the module is shared)
+users = Repository("users_db")
+outbox = Repository("users_outbox")
+idempotency = Repository("idempotency_keys")